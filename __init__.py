@@ -14,12 +14,14 @@ def register():
     Pool.register(
         voyager.Site,
         voyager.Session,
+        voyager.MarkdownCache,
         voyager.Component,
         voyager.VoyagerURI,
         voyager.User,
         utils.Menu,
         voyager.VoyagerUriBuilderAsk,
         voyager.VoyagerUriBuilderResult,
+        voyager.Cron,
         module='voyager', type_='model')
     Pool.register(
         voyager.VoyagerUriBuilder,
@@ -27,4 +29,5 @@ def register():
     Pool.register(
         sale.Site,
         sale.Sale,
+        sale.Session,
         module='voyager', type_='model', depends=['sale', 'web_shop'])
@@ -1,14 +1,38 @@
+import gc
+import logging
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from urllib.parse import urljoin, urlparse
+
 import click
 from werkzeug import Request
+from werkzeug.exceptions import NotFound
+from werkzeug.test import EnvironBuilder
 import trytond.config as config
+from trytond import backend
+from trytond.cache import Cache
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.modules.voyager import voyager
+from trytond.modules.voyager.middleware import (
+    GzipMiddleware, StaticMiddleware, STATIC_FOLDER, build_static)
 
 import os
-from werkzeug.middleware.shared_data import SharedDataMiddleware
 
-MODULES_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+logger = logging.getLogger(__name__)
+
+
+def parse_hosts(value):
+    '''
+    Return the databases by host of the "host=database" entries of value,
+    separated by commas or new lines
+    '''
+    hosts = {}
+    for entry in (value or '').replace(',', '\n').splitlines():
+        host, _, database = entry.partition('=')
+        if host.strip() and database.strip():
+            hosts[host.strip().lower()] = database.strip()
+    return hosts
 
 @click.group()
 def main():
@@ -24,19 +48,209 @@ class VoyagerWSGI(object):
         self.site_id = config.getint('voyager', 'site_id')
         self.user_id = config.getint('voyager', 'user_id')
         self.Site = None
+        self.hosts = parse_hosts(config.get('voyager', 'hosts', default=''))
+        self.max_pools = config.getint('voyager', 'max_pools', default=4)
+        self.pools = OrderedDict()
+        self._active = Counter()
+        self._lock = threading.Lock()
+        self._init_locks = defaultdict(threading.Lock)
 
     def start(self):
         Pool.start()
-        self.pool = Pool(self.database)
-        self.pool.init()
+        self.pool = self.get_pool(self.database)
         self.Site = self.pool.get('www.site')
 
+    def get_database(self, request):
+        'Return the database of the request host'
+        host = request.host.lower()
+        database = self.hosts.get(host)
+        if database is None:
+            database = self.hosts.get(host.rsplit(':', 1)[0])
+        return database or self.database
+
+    def get_pool(self, database, acquire=False):
+        '''
+        Return the initialized pool of database, the least recently used
+        pools not serving requests are removed over max_pools
+
+        With acquire the pool is kept until release_pool is called.
+        '''
+        with self._lock:
+            pool = self.pools.get(database)
+            if pool is not None:
+                self.pools.move_to_end(database)
+            if acquire:
+                self._active[database] += 1
+        if pool is not None:
+            return pool
+        try:
+            with self._init_locks[database]:
+                pool = self.pools.get(database)
+                if pool is None:
+                    pool = Pool(database)
+                    pool.init()
+                    with self._lock:
+                        self.pools[database] = pool
+                        self._evict(keep=database)
+        except BaseException:
+            if acquire:
+                self.release_pool(database)
+            raise
+        return pool
+
+    def release_pool(self, database):
+        with self._lock:
+            self._active[database] -= 1
+            if not self._active[database]:
+                del self._active[database]
+
+    def _evict(self, keep=None):
+        idle = [d for d in self.pools
+            if d not in {self.database, keep} and not self._active[d]]
+        while len(self.pools) > self.max_pools and idle:
+            database = idle.pop(0)
+            del self.pools[database]
+            Pool.stop(database)
+            Cache.drop(database)
+            voyager.CacheManager.evict(database)
+            self._close_database(database)
+            logger.info('Pool of %s removed', database)
+
+    @staticmethod
+    def _close_database(database):
+        'Close the connections kept by the backend for database, if any'
+        # Database() would open a new connection pool for the database
+        databases = getattr(backend.Database, '_databases', {})
+        instance = databases.get(os.getpid(), {}).get(database)
+        if instance is None:
+            return
+        try:
+            instance.close()
+        except Exception:
+            logger.warning('Error closing the connections of %s', database,
+                exc_info=True)
+
+    def warmup(self, paths=None):
+        '''
+        Load the sites with their routing tables and the templates, and render
+        the paths, so the workers forked afterwards (gunicorn --preload) share
+        them instead of building them on their first requests.
+
+        Without site_type nor site_id the paths are urls, or paths rendered on
+        each site, and the site of each one is chosen by its host and path.
+        '''
+        if self.pool is None:
+            self.start()
+        Module = self.pool.get('ir.module')
+        with Transaction().start(self.database, self.user_id,
+                readonly=False) as transaction:
+            modules = [m.name for m in Module.search([
+                        ('state', '=', 'activated'),
+                        ])]
+            voyager.Component.preload_templates(modules)
+
+            multisite = not self.site_type and not self.site_id
+            domain = []
+            if self.site_id:
+                domain.append(('id', '=', self.site_id))
+            elif self.site_type:
+                domain.append(('type', '=', self.site_type))
+            sites = self.Site.search(domain)
+            for site in sites:
+                web_prefix = None
+                if multisite:
+                    web_prefix = urlparse(site.url).path.rstrip('/') or None
+                site.get_site_info(web_prefix)
+                # The compiled templates are kept by site
+                with Transaction().set_context(
+                        voyager_context=voyager.VoyagerContext(site=site,
+                            web_prefix=web_prefix)):
+                    voyager.Component.compile_templates(modules)
+
+            # Rendering pages fills the caches
+            for url in self._warmup_urls(paths or [], sites, multisite):
+                parsed = urlparse(url)
+                base_url = None
+                if parsed.netloc:
+                    base_url = f'{parsed.scheme}://{parsed.netloc}'
+                request = EnvironBuilder(path=parsed.path or '/',
+                    query_string=parsed.query, base_url=base_url).get_request()
+                site_type, site_id, web_prefix = (
+                    self.site_type, self.site_id, None)
+                if multisite:
+                    match = self.Site.match_site(request)
+                    if not match:
+                        logger.warning('No site found to warm up %s', url)
+                        continue
+                    site_id, site_type, web_prefix = match
+                try:
+                    self.Site.dispatch(site_type, site_id, request,
+                        self.user_id, web_prefix=web_prefix)
+                except Exception:
+                    logger.warning('Error warming up %s', url, exc_info=True)
+            # Do not keep the sessions created by the requests
+            transaction.rollback()
+        # Move the objects created so far out of the garbage collector so the
+        # forked workers do not copy their pages when it runs
+        gc.freeze()
+
+    @staticmethod
+    def _warmup_urls(paths, sites, multisite):
+        'Yield the urls of the paths to warm up'
+        for path in paths:
+            if urlparse(path).netloc:
+                yield path
+            elif multisite:
+                for site in sites:
+                    yield site.url.rstrip('/') + '/' + path.lstrip('/')
+            elif sites:
+                yield urljoin(sites[0].url, path)
+            else:
+                yield path
+
     def dispatch_request(self, request):
+        database = self.get_database(request)
+        if not database:
+            return NotFound().get_response(request.environ)
+        pool = self.get_pool(database, acquire=True)
+        Site = pool.get('www.site')
+
+        def stop(commit):
+            try:
+                transaction.stop(commit)
+            finally:
+                self.release_pool(database)
+
         # TODO: Would be great if we found a way to define which transactions
         # are readonly and which are not
-        with Transaction().start(self.database, self.user_id, readonly=False):
-            return self.Site.dispatch(self.site_type, self.site_id, request,
-                self.user_id)
+        try:
+            transaction = Transaction().start(database, self.user_id,
+                readonly=False)
+        except BaseException:
+            self.release_pool(database)
+            raise
+        try:
+            site_type, site_id, web_prefix = (
+                self.site_type, self.site_id, None)
+            if not site_type and not site_id:
+                # Serve all the sites, choosing them by host and path
+                match = Site.match_site(request)
+                if match:
+                    site_id, site_type, web_prefix = match
+            if site_type or site_id:
+                response = Site.dispatch(site_type, site_id, request,
+                    self.user_id, web_prefix=web_prefix)
+            else:
+                response = NotFound().get_response(request.environ)
+        except BaseException:
+            stop(False)
+            raise
+        if getattr(response, 'keep_transaction', False):
+            # Streamed responses are rendered while they are iterated
+            response.call_on_close(lambda: stop(True))
+        else:
+            stop(True)
+        return response
 
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
@@ -47,16 +261,18 @@ class VoyagerWSGI(object):
         return self.wsgi_app(environ, start_response)
 
 
-static_folder = config.get('voyager', 'static_folder')
 app = VoyagerWSGI()
-app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
-    '/static': os.path.join(MODULES_PATH, static_folder)})
+if config.getboolean('voyager', 'gzip', default=True):
+    app.wsgi_app = GzipMiddleware(app.wsgi_app)
+app.wsgi_app = StaticMiddleware(app.wsgi_app, STATIC_FOLDER)
 
 app.database = config.get('voyager', 'database')
 if not app.database:
     app.database = os.environ.get('TRYTOND_DATABASE_NAMES')
 if app.database:
     app.start()
+    if config.getboolean('voyager', 'warmup', default=False):
+        app.warmup(config.get('voyager', 'warmup_paths', default='').split())
 
 @main.command()
 @click.argument('database')
@@ -87,9 +303,36 @@ def run(database, site_type, site_id, user_id, host, port, dev, disable_cache,
         app.user_id = user_id
     app.start()
 
-    run_simple(host, port, SharedDataMiddleware(app, {
-        '/static': os.path.join(os.path.dirname(__file__), static_folder)}),
+    run_simple(host, port, StaticMiddleware(app,
+            os.path.join(os.path.dirname(__file__), static_folder)),
         use_debugger=True, use_reloader=dev)
 
+
+@main.command('clean-sessions')
+@click.argument('database')
+@click.option('--batch-size', default=None, type=int,
+    help='Sessions deleted on each transaction')
+@click.option('--config-file', default=None)
+def clean_sessions(database, batch_size, config_file):
+    'Delete the expired sessions'
+    if config_file:
+        config.update_etc(config_file)
+    app.database = database
+    app.start()
+
+    Session = app.pool.get('www.session')
+    with Transaction().start(database, 0):
+        deleted = Session.clean_expired(batch_size)
+    click.echo(f'{deleted} sessions deleted')
+
+
+@main.command('build-static')
+@click.option('--static-folder', default=None,
+    help='Path to the static folder, the configured one by default')
+def build_static_files(static_folder):
+    'Write the content-hashed and compressed static files and their manifest'
+    manifest = build_static(static_folder or STATIC_FOLDER)
+    click.echo(f'{len(manifest)} static files built')
+
 if __name__ == '__main__':
     main()
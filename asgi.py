@@ -0,0 +1,253 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import asyncio
+import contextlib
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import trytond.config as config
+
+from .events import AsyncSubscription, TriggerBroker
+
+logger = logging.getLogger(__name__)
+
+
+def build_environ(scope, body):
+    'Return the WSGI environ of an ASGI http scope'
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode(
+            'latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # The event streams are served by the event loop
+        'voyager.asgi': True,
+        }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in {'CONTENT_TYPE', 'CONTENT_LENGTH'}:
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        if key in environ:
+            value = f'{environ[key]},{value}'
+        environ[key] = value
+    return environ
+
+
+class VoyagerASGI:
+    '''
+    ASGI application that runs a WSGI application (VoyagerWSGI) in a bounded
+    thread pool
+
+    The connections are kept by the ASGI server so idle keep-alive and htmx
+    connections do not hold a thread, only the requests being dispatched do.
+    Each request is dispatched and its body iterated in the same thread, so
+    its transaction (and database connection) belongs to that thread.
+    '''
+
+    def __init__(self, app, max_workers=None):
+        self.app = app
+        if max_workers is None:
+            max_workers = config.getint('voyager', 'asgi_workers', default=16)
+        self.max_workers = max_workers
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='voyager-asgi')
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported scope type %s' % scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = build_environ(scope, b''.join(chunks))
+
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        disconnected = threading.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        future = loop.run_in_executor(self.executor, self.run_wsgi,
+            environ, loop, messages, disconnected)
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                if isinstance(message, tuple):
+                    _, session_id = message
+                    await self.stream_events(session_id, send, watcher)
+                elif not disconnected.is_set():
+                    await send(message)
+            await future
+        finally:
+            disconnected.set()
+            watcher.cancel()
+
+    async def stream_events(self, session_id, send, disconnection):
+        '''
+        Send the trigger events of the session until the stream times out or
+        the disconnection future is done
+        '''
+        subscription = AsyncSubscription(asyncio.get_running_loop())
+        TriggerBroker.subscribe(session_id, subscription)
+        events = subscription.stream()
+        try:
+            while True:
+                event = asyncio.ensure_future(events.__anext__())
+                await asyncio.wait({event, disconnection},
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not event.done():
+                    event.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await event
+                    break
+                try:
+                    body = event.result().encode('utf-8')
+                except StopAsyncIteration:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                await send({
+                        'type': 'http.response.body',
+                        'body': body,
+                        'more_body': True,
+                        })
+        finally:
+            await events.aclose()
+            TriggerBroker.unsubscribe(session_id, subscription)
+
+    def run_wsgi(self, environ, loop, messages, disconnected):
+        '''
+        Call the WSGI application and put the ASGI messages of the response in
+        the messages queue of the event loop, it runs in a worker thread
+        '''
+        def put(message):
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response_start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start['message'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in headers],
+                }
+
+        def send_start():
+            if not response_start.get('sent'):
+                put(response_start['message'])
+                response_start['sent'] = True
+
+        iterable = None
+        try:
+            iterable = self.app(environ, start_response)
+            for chunk in iterable:
+                if disconnected.is_set():
+                    break
+                if chunk:
+                    send_start()
+                    put({
+                            'type': 'http.response.body',
+                            'body': chunk,
+                            'more_body': True,
+                            })
+            session_id = environ.get('voyager.event_stream')
+            if session_id is not None:
+                # The event loop sends the events, the thread is released. The
+                # body is not empty so it can not have a length.
+                message = response_start['message']
+                message['headers'] = [(k, v) for k, v in message['headers']
+                    if k != b'content-length']
+                send_start()
+                put(('event_stream', session_id))
+            else:
+                send_start()
+                put({'type': 'http.response.body', 'body': b''})
+        except Exception:
+            logger.exception('Error dispatching %s', environ['PATH_INFO'])
+            body = b''
+            if not response_start.get('sent'):
+                put({
+                        'type': 'http.response.start',
+                        'status': 500,
+                        'headers': [(b'content-type', b'text/plain')],
+                        })
+                body = b'Internal Server Error'
+            put({'type': 'http.response.body', 'body': body})
+        finally:
+            try:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            finally:
+                put(None)
+
+
+def get_application():
+    '''
+    Return the ASGI application of the configured VoyagerWSGI, to be used as
+    factory by the ASGI server:
+
+        uvicorn --factory trytond.modules.voyager.asgi:get_application
+    '''
+    from trytond.modules.voyager.app import app
+    return VoyagerASGI(app)
@@ -0,0 +1,183 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import asyncio
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import trytond.config as config
+
+SSE_QUEUE_SIZE = config.getint('voyager', 'sse_queue_size', default=100)
+SSE_HEARTBEAT = config.getint('voyager', 'sse_heartbeat', default=15)
+SSE_TIMEOUT = config.getint('voyager', 'sse_timeout', default=300)
+# Milliseconds the client waits before reconnecting
+SSE_RETRY = config.getint('voyager', 'sse_retry', default=3000)
+# Streams served at once by the WSGI workers, each one holds a thread while it
+# is open. The ASGI application serves them without threads.
+SSE_MAX_STREAMS = config.getint('voyager', 'sse_max_streams', default=8)
+
+
+def format_event(name, data=''):
+    'Return a server-sent event message'
+    lines = [f'event: {name}']
+    for line in str(data).splitlines() or ['']:
+        lines.append(f'data: {line}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class TriggerBroker:
+    '''
+    In-process publish/subscribe of trigger events by session
+    '''
+    _subscribers = defaultdict(set)
+    _lock = threading.Lock()
+    _streams = 0
+
+    @classmethod
+    def subscribe(cls, session_id, subscription=None):
+        '''
+        Return the subscription of session_id, a queue or any object with
+        put_nowait
+        '''
+        if subscription is None:
+            subscription = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with cls._lock:
+            cls._subscribers[session_id].add(subscription)
+        return subscription
+
+    @classmethod
+    def unsubscribe(cls, session_id, subscription):
+        with cls._lock:
+            subscriptions = cls._subscribers.get(session_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del cls._subscribers[session_id]
+
+    @classmethod
+    def publish(cls, name, session_ids=None, data=''):
+        '''
+        Send the event to the subscriptions of session_ids or to all the
+        subscriptions if session_ids is None
+        '''
+        with cls._lock:
+            if session_ids is None:
+                subscriptions = [s for subscriptions in
+                    cls._subscribers.values() for s in subscriptions]
+            else:
+                subscriptions = [s for session_id in session_ids
+                    for s in cls._subscribers.get(session_id, ())]
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait((name, data))
+            except queue.Full:
+                # The client does not read its events, it will get the next
+                # ones once it catches up
+                pass
+
+    @classmethod
+    def acquire_stream(cls, maximum=SSE_MAX_STREAMS):
+        'Return True if one more blocking stream can be served'
+        with cls._lock:
+            if maximum and cls._streams >= maximum:
+                return False
+            cls._streams += 1
+            return True
+
+    @classmethod
+    def release_stream(cls):
+        with cls._lock:
+            cls._streams -= 1
+
+    @classmethod
+    def stream(cls, session_id, subscription, heartbeat=SSE_HEARTBEAT,
+            timeout=SSE_TIMEOUT):
+        '''
+        Yield the events of the subscription as server-sent events until
+        timeout (the client reconnects) or the stream is closed
+        '''
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            yield f'retry: {SSE_RETRY}\n\n'
+            while deadline is None or time.monotonic() < deadline:
+                try:
+                    name, data = subscription.get(timeout=heartbeat)
+                except queue.Empty:
+                    # Comments keep the connection alive and detect the
+                    # closed ones
+                    yield ': heartbeat\n\n'
+                else:
+                    yield format_event(name, data)
+        finally:
+            cls.unsubscribe(session_id, subscription)
+
+
+class AsyncSubscription:
+    '''
+    Subscription that puts the events in an asyncio queue from any thread
+    '''
+
+    def __init__(self, loop, maxsize=SSE_QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    def put_nowait(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    async def stream(self, heartbeat=SSE_HEARTBEAT, timeout=SSE_TIMEOUT):
+        '''
+        Yield the server-sent events like TriggerBroker.stream without
+        blocking a thread
+        '''
+        deadline = time.monotonic() + timeout if timeout else None
+        yield f'retry: {SSE_RETRY}\n\n'
+        while deadline is None or time.monotonic() < deadline:
+            wait = heartbeat
+            if deadline is not None:
+                wait = max(min(heartbeat, deadline - time.monotonic()), 0)
+            try:
+                name, data = await asyncio.wait_for(self.queue.get(), wait)
+            except asyncio.TimeoutError:
+                yield ': heartbeat\n\n'
+            else:
+                yield format_event(name, data)
+
+
+class TriggerDataManager:
+    '''
+    Publish the trigger events of a transaction once it is committed
+    '''
+
+    def __init__(self):
+        self.events = []
+
+    def __eq__(self, other):
+        return isinstance(other, TriggerDataManager)
+
+    def abort(self, trans):
+        self.events = []
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        for name, session_ids, data in self.events:
+            TriggerBroker.publish(name, session_ids, data)
+        self.events = []
+
+    def tpc_abort(self, trans):
+        self.events = []
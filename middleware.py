@@ -0,0 +1,234 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+from werkzeug.wsgi import ClosingIterator
+
+import trytond.config as config
+
+MODULES_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+STATIC_FOLDER = os.path.join(MODULES_PATH,
+    config.get('voyager', 'static_folder', default='voyager/static'))
+GZIP_MIN_SIZE = config.getint('voyager', 'gzip_min_size', default=1024)
+GZIP_LEVEL = config.getint('voyager', 'gzip_level', default=6)
+# Seconds the browsers keep the static files without a hashed name
+STATIC_MAX_AGE = config.getint('voyager', 'static_max_age', default=60 * 60)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+MANIFEST = 'manifest.json'
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml',
+    }
+# Files built by build_static: name.<hash>.ext
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+_manifests = {}
+
+
+def compressible(content_type):
+    'Return True if the responses of content_type are worth compressing'
+    mimetype = (content_type or '').split(';', 1)[0].strip().lower()
+    if mimetype == 'text/event-stream':
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+
+
+def accepts_gzip(environ):
+    encodings = environ.get('HTTP_ACCEPT_ENCODING', '').lower()
+    return any(e.split(';', 1)[0].strip() == 'gzip' and 'q=0' not in e
+        for e in encodings.split(','))
+
+
+def add_vary(headers, value):
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = value
+    elif value.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        headers['Vary'] = f'{vary}, {value}'
+
+
+class GzipMiddleware:
+    '''
+    Compress the responses of the application with gzip when the client
+    accepts it
+
+    The responses with Content-Length are compressed at once if they are
+    bigger than minimum_size, the streamed ones chunk by chunk.
+    '''
+
+    def __init__(self, app, minimum_size=GZIP_MIN_SIZE, level=GZIP_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        started, chunks = [], []
+
+        def capture(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+            return chunks.append
+
+        iterable = self.app(environ, capture)
+        iterator = iter(iterable)
+        if not started:
+            # The application starts the response with its first chunk
+            chunks.append(next(iterator, b''))
+        status, headers, exc_info = started
+        headers = Headers(headers)
+
+        if (status[:3] in {'204', '304'}
+                or 'Content-Encoding' in headers
+                or not compressible(headers.get('Content-Type'))):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return ClosingIterator(self._chain(chunks, iterator),
+                getattr(iterable, 'close', None))
+
+        add_vary(headers, 'Accept-Encoding')
+        if not accepts_gzip(environ):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return ClosingIterator(self._chain(chunks, iterator),
+                getattr(iterable, 'close', None))
+
+        if 'Content-Length' in headers:
+            try:
+                chunks.extend(iterator)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            body = b''.join(chunks)
+            if len(body) >= self.minimum_size:
+                body = gzip.compress(body, self.level)
+                headers['Content-Encoding'] = 'gzip'
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+
+        headers['Content-Encoding'] = 'gzip'
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return ClosingIterator(self._compress(self._chain(chunks, iterator)),
+            getattr(iterable, 'close', None))
+
+    @staticmethod
+    def _chain(chunks, iterator):
+        yield from chunks
+        yield from iterator
+
+    def _compress(self, chunks):
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            if chunk:
+                # Flush each chunk so the streamed responses keep streaming
+                yield (compressor.compress(chunk)
+                    + compressor.flush(zlib.Z_SYNC_FLUSH))
+        yield compressor.flush()
+
+
+class StaticMiddleware:
+    '''
+    Serve the files of directory under prefix, with the precompressed .gz
+    sibling when the client accepts it
+
+    The files with a hashed name (built by build_static) are cached by the
+    browsers for a year, the others for STATIC_MAX_AGE seconds.
+    '''
+
+    def __init__(self, app, directory=STATIC_FOLDER, prefix='/static',
+            max_age=STATIC_MAX_AGE):
+        self.app = app
+        self.directory = directory
+        self.prefix = prefix.rstrip('/') + '/'
+        self.max_age = max_age
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if (not path.startswith(self.prefix)
+                or environ.get('REQUEST_METHOD', 'GET') not in {
+                    'GET', 'HEAD'}):
+            return self.app(environ, start_response)
+        filename = safe_join(self.directory, path[len(self.prefix):])
+        if not filename or not os.path.isfile(filename):
+            return self.app(environ, start_response)
+
+        immutable = bool(HASHED_RE.search(filename))
+        max_age = IMMUTABLE_MAX_AGE if immutable else self.max_age
+        mimetype = mimetypes.guess_type(filename)[0]
+        gz_filename = filename + '.gz'
+        encoded = (compressible(mimetype) and accepts_gzip(environ)
+            and os.path.isfile(gz_filename)
+            and (os.path.getmtime(gz_filename)
+                >= os.path.getmtime(filename)))
+        response = send_file(gz_filename if encoded else filename, environ,
+            mimetype=mimetype or 'application/octet-stream',
+            max_age=max_age)
+        if encoded:
+            response.headers['Content-Encoding'] = 'gzip'
+        if compressible(mimetype):
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.cache_control.immutable = True
+        return response(environ, start_response)
+
+
+def build_static(directory=STATIC_FOLDER, level=9):
+    '''
+    Copy the files of directory to content-hashed names, write their .gz
+    siblings and the manifest that maps the names to the hashed ones
+
+    Return the manifest
+    '''
+    manifest = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            if (name == MANIFEST or filename.endswith('.gz')
+                    or HASHED_RE.search(filename)):
+                continue
+            with open(path, 'rb') as f:
+                content = f.read()
+            digest = hashlib.sha256(content).hexdigest()[:12]
+            root, ext = os.path.splitext(name)
+            hashed = f'{root}.{digest}{ext}'
+            hashed_path = os.path.join(directory, hashed)
+            if not os.path.exists(hashed_path):
+                shutil.copyfile(path, hashed_path)
+            if compressible(mimetypes.guess_type(filename)[0]):
+                for target in (path, hashed_path):
+                    with open(target + '.gz', 'wb') as f:
+                        f.write(gzip.compress(content, level, mtime=0))
+            manifest[name] = hashed
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    _manifests.pop(directory, None)
+    return manifest
+
+
+def static_url(name, directory=STATIC_FOLDER, prefix='/static'):
+    '''
+    Return the url of the static file name, with its hashed name if it is in
+    the manifest
+    '''
+    manifest = _manifests.get(directory)
+    if manifest is None:
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        _manifests[directory] = manifest
+    return f'{prefix}/{manifest.get(name, name)}'
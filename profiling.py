@@ -0,0 +1,323 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict, deque
+
+import trytond.config as config
+from trytond.transaction import Transaction
+
+PROFILE_ENABLED = config.getboolean('voyager', 'profile', default=False)
+PROFILE_SAMPLES = config.getint('voyager', 'profile_samples', default=1000)
+METRICS_ENABLED = config.getboolean('voyager', 'metrics', default=False)
+# Token to send as "Authorization: Bearer <token>" to read the metrics without
+# a session of a system user
+METRICS_TOKEN = config.get('voyager', 'metrics_token', default=None)
+# The size of the cached output is measured once every N cache misses
+METRICS_SIZE_SAMPLE = config.getint('voyager', 'metrics_size_sample',
+    default=10)
+# Upper bounds in milliseconds of the render time histogram buckets
+RENDER_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, pct):
+    '''
+    Return the nearest-rank percentile of values
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = math.ceil(pct / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+class _CursorProxy:
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _ConnectionProxy:
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CursorProxy(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class QueryCounter:
+    '''
+    Count the SQL queries executed by the current transaction while it is
+    active by wrapping the cursors of its connection
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self._transaction = None
+        self._connection = None
+
+    def start(self):
+        self._transaction = Transaction()
+        self._connection = self._transaction.connection
+        self._transaction.connection = _ConnectionProxy(
+            self._connection, self)
+        return self
+
+    def stop(self):
+        if self._transaction is not None:
+            self._transaction.connection = self._connection
+            self._transaction = self._connection = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class RequestProfile:
+    '''
+    Record the time and the SQL queries spent on each phase of a request
+
+    The phases are delimited with mark(name), which closes the phase started
+    by the previous mark (or by start)
+    '''
+
+    def __init__(self, request=None):
+        self.request = request
+        self.endpoint = None
+        self.budget = None
+        self.phases = []
+        self.queries = QueryCounter()
+        self._start = None
+        self._last = None
+        self._last_queries = 0
+
+    @classmethod
+    def start(cls, request=None, force=False):
+        if not PROFILE_ENABLED and not force:
+            return NULL_PROFILE
+        profile = cls(request)
+        profile._start = profile._last = time.perf_counter()
+        profile.queries.start()
+        return profile
+
+    def mark(self, name):
+        now = time.perf_counter()
+        count = self.queries.count
+        self.phases.append(
+            (name, now - self._last, count - self._last_queries))
+        self._last = now
+        self._last_queries = count
+
+    def stop(self):
+        self.queries.stop()
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+    def server_timing(self):
+        metrics = [f'{name};dur={duration * 1000:.2f}'
+            for name, duration, _ in self.phases]
+        metrics.append(f'total;dur={self.total * 1000:.2f}')
+        metrics.append(f'db;desc="{self.queries.count} queries"')
+        return ', '.join(metrics)
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.queries.count > self.budget
+
+    def as_dict(self):
+        return {
+            'endpoint': self.endpoint,
+            'path': getattr(self.request, 'path', None),
+            'total': round(self.total * 1000, 2),
+            'queries': self.queries.count,
+            'phases': {
+                name: {'duration': round(duration * 1000, 2),
+                    'queries': queries}
+                for name, duration, queries in self.phases},
+            }
+
+    def finish(self, response=None):
+        '''
+        Add the Server-Timing header to the response, log the profile and add
+        it to the endpoint statistics
+        '''
+        self.stop()
+        if self.phases:
+            # Time spent after the last mark
+            self.mark('other')
+        if response is not None and hasattr(response, 'headers'):
+            response.headers['Server-Timing'] = self.server_timing()
+        logger.info('request profile: %s', json.dumps(self.as_dict()))
+        if self.over_budget:
+            logger.warning('%s executed %d queries, over its budget of %d',
+                self.endpoint, self.queries.count, self.budget)
+        EndpointStats.add(self.endpoint, self.total, self.queries.count)
+
+
+class _NullProfile:
+    endpoint = None
+    budget = None
+
+    def mark(self, name):
+        pass
+
+    def stop(self):
+        pass
+
+    def finish(self, response=None):
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+
+class EndpointStats:
+    '''
+    Keep the duration and SQL queries of the last requests of each endpoint
+    '''
+    _samples = defaultdict(lambda: deque(maxlen=PROFILE_SAMPLES))
+    _counts = defaultdict(int)
+    _lock = threading.Lock()
+
+    @classmethod
+    def add(cls, endpoint, duration, queries):
+        with cls._lock:
+            cls._samples[endpoint].append((duration, queries))
+            cls._counts[endpoint] += 1
+
+    @classmethod
+    def summary(cls):
+        with cls._lock:
+            samples = {k: list(v) for k, v in cls._samples.items()}
+            counts = dict(cls._counts)
+        result = {}
+        for endpoint, values in samples.items():
+            durations = [d * 1000 for d, _ in values]
+            queries = [q for _, q in values]
+            result[endpoint] = {
+                'count': counts[endpoint],
+                'p50': percentile(durations, 50),
+                'p90': percentile(durations, 90),
+                'p99': percentile(durations, 99),
+                'max': max(durations),
+                'queries_avg': sum(queries) / len(queries),
+                'queries_max': max(queries),
+                }
+        return result
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._samples.clear()
+            cls._counts.clear()
+
+
+class ComponentStats:
+    '''
+    Keep the cache hits and misses, the render time histogram and the size of
+    the cached output of each component class (measured on a sample of the
+    misses as it serializes the output once more)
+    '''
+    _stats = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _get(cls, name):
+        stats = cls._stats.get(name)
+        if stats is None:
+            stats = cls._stats[name] = {
+                'hits': 0,
+                'misses': 0,
+                'renders': 0,
+                'render_time': 0.0,
+                'histogram': [0] * len(RENDER_BUCKETS),
+                'cached_size': 0,
+                }
+        return stats
+
+    @classmethod
+    def hit(cls, name):
+        with cls._lock:
+            cls._get(name)['hits'] += 1
+
+    @classmethod
+    def sample_size(cls, name, sample=METRICS_SIZE_SAMPLE):
+        'Return True if the size of the next cache miss must be measured'
+        with cls._lock:
+            return cls._get(name)['misses'] % max(sample, 1) == 0
+
+    @classmethod
+    def rendered(cls, name, duration, cached=False, size=None):
+        '''
+        Add a render of duration seconds, cached tells if the render was a
+        cache miss and size the length of the output stored in the cache
+        '''
+        duration *= 1000
+        with cls._lock:
+            stats = cls._get(name)
+            stats['renders'] += 1
+            stats['render_time'] += duration
+            for i, bound in enumerate(RENDER_BUCKETS):
+                if duration <= bound:
+                    stats['histogram'][i] += 1
+                    break
+            if cached:
+                stats['misses'] += 1
+                if size is not None:
+                    stats['cached_size'] = size
+
+    @classmethod
+    def summary(cls):
+        with cls._lock:
+            stats = {k: dict(v, histogram=list(v['histogram']))
+                for k, v in cls._stats.items()}
+        for value in stats.values():
+            lookups = value['hits'] + value['misses']
+            value['hit_ratio'] = value['hits'] / lookups if lookups else None
+            value['render_avg'] = (value['render_time'] / value['renders']
+                if value['renders'] else None)
+            value['histogram'] = {
+                str(bound): count
+                for bound, count in zip(RENDER_BUCKETS, value['histogram'])}
+        return stats
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._stats.clear()
@@ -1,5 +1,7 @@
-from trytond.pool import PoolMeta
-from trytond.model import fields
+from sql.operators import Exists
+
+from trytond.pool import Pool, PoolMeta
+from trytond.model import Index, fields
 
 class Site(metaclass=PoolMeta):
     __name__ = 'www.site'
@@ -11,3 +13,23 @@ class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
 
     session = fields.Many2One('www.session', "Session")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.session, Index.Range())))
+
+
+class Session(metaclass=PoolMeta):
+    __name__ = 'www.session'
+
+    @classmethod
+    def _clean_expired_where(cls, session):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        sale = Sale.__table__()
+        # Keep the sessions of the sales
+        return (super()._clean_expired_where(session)
+            & ~Exists(sale.select(sale.id,
+                    where=sale.session == session.id)))
@@ -0,0 +1,104 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Compact html serialization of dominate trees
+
+The htmx attributes (hx_get, sse_connect...) are written with dashes when
+they are emitted, so the text of the document is never rewritten.
+'''
+from dominate import document
+from dominate.dom_tag import dom_tag
+from dominate.tags import comment, html_tag
+from dominate.util import container, escape, text
+
+import trytond.config as config
+
+SERIALIZE_CHUNK = config.getint('voyager', 'serialize_chunk', default=16384)
+# Prefixes of the attributes that are written with dashes
+DASHED_PREFIXES = ('hx_', 'sse_', 'ws_')
+
+_attribute_names = {}
+
+
+def attribute_name(name):
+    'Return the html name of the attribute'
+    try:
+        return _attribute_names[name]
+    except KeyError:
+        html_name = name
+        if name.startswith(DASHED_PREFIXES):
+            html_name = name.replace('_', '-')
+        _attribute_names[name] = html_name
+        return html_name
+
+
+def tag_name(node):
+    name = getattr(node, 'tagname', None) or type(node).__name__
+    if name.endswith('_'):
+        name = name[:-1]
+    return name
+
+
+def iter_tokens(node):
+    '''
+    Yield the html of node in small pieces
+
+    The strings found in the tree are written as they are: dominate escapes
+    the text children when they are added, and the closing tags are pushed to
+    the stack as strings.
+    '''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            yield node
+        elif isinstance(node, text):
+            # dominate escapes the text when the node is created
+            yield node.text
+        elif isinstance(node, container):
+            stack.extend(reversed(node.children))
+        elif isinstance(node, comment):
+            yield node.render(pretty=False)
+        elif isinstance(node, html_tag):
+            if isinstance(node, document):
+                yield f'{node.doctype}\n'
+            name = tag_name(node)
+            attributes = []
+            for attribute, value in node.attributes.items():
+                if value is None or value is False:
+                    continue
+                if value is True:
+                    value = attribute
+                if isinstance(value, text) and not value.escape:
+                    value = value.text
+                else:
+                    value = escape(str(value), True)
+                attributes.append(f' {attribute_name(attribute)}="{value}"')
+            yield f'<{name}{"".join(attributes)}>'
+            if node.is_single:
+                continue
+            stack.append(f'</{name}>')
+            stack.extend(reversed(node.children))
+        elif isinstance(node, dom_tag):
+            yield node.render(pretty=False)
+        elif node is not None:
+            yield str(node)
+
+
+def serialize(node):
+    'Return the html of node'
+    return ''.join(iter_tokens(node))
+
+
+def iter_serialize(node, chunk_size=SERIALIZE_CHUNK):
+    'Yield the html of node in chunks of about chunk_size characters'
+    buffer, size = [], 0
+    for token in iter_tokens(node):
+        buffer.append(token)
+        size += len(token)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
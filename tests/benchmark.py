@@ -0,0 +1,288 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmark of the VoyagerWSGI dispatch hot path
+
+It registers a synthetic site type with N endpoints that render nested
+components, activates the module in the test database (SQLite in memory by
+default) and measures the requests per second, the latency percentiles and the
+SQL queries per request of each scenario (endpoint or URI routing, with and
+without cache).
+
+With --import-time it measures the time to import the module and reports the
+web modules it loads, which non-web processes (cron, workers) should not pay.
+
+    python -m trytond.modules.voyager.tests.benchmark --endpoints 20 \\
+        --uris 200 --save baseline.json
+    python -m trytond.modules.voyager.tests.benchmark --compare baseline.json
+    python -m trytond.modules.voyager.tests.benchmark --import-time
+'''
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+
+from dominate.tags import div, p
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tests.test_tryton import DB_NAME, activate_module
+from trytond.transaction import Transaction
+from werkzeug.test import Client
+
+from trytond.modules.voyager import profiling, voyager
+from trytond.modules.voyager.profiling import percentile
+from trytond.modules.voyager.voyager import Component, Endpoint
+
+SITE_TYPE = 'benchmark'
+SETTINGS = {
+    'depth': 2,
+    'width': 3,
+    }
+QUERIES_RE = re.compile(r'db;desc="(\d+) queries"')
+IMPORT_TIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| *(\S+)')
+WEB_MODULES = ('jinja2', 'markdown', 'dominate', 'werkzeug.routing', 'click')
+
+
+class BenchmarkSite(metaclass=PoolMeta):
+    __name__ = 'www.site'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.type.selection.append((SITE_TYPE, 'Benchmark'))
+
+
+class BenchmarkComponent(Component):
+    'Benchmark Component'
+    __name__ = 'www.benchmark.component'
+
+    level = fields.Integer('Level')
+    position = fields.Integer('Position')
+
+    def render(self):
+        node = div(cls='component', hx_get='#',
+            id=f'component-{self.level}-{self.position}')
+        node.add(p(f'Component {self.level}.{self.position}'))
+        if self.level < SETTINGS['depth']:
+            for position in range(SETTINGS['width']):
+                node.add(self.__class__(
+                        level=self.level + 1, position=position).tag())
+        return node
+
+
+class BenchmarkEndpoint(Endpoint):
+    _type = SITE_TYPE
+
+    def render(self):
+        page = div(id='page')
+        for position in range(SETTINGS['width']):
+            page.add(BenchmarkComponent(level=1, position=position).tag())
+        return page
+
+
+def endpoint_classes(number):
+    return [type(f'BenchmarkEndpoint{i}', (BenchmarkEndpoint,), {
+                '__doc__': f'Benchmark Endpoint {i}',
+                '__name__': f'www.benchmark.endpoint{i}',
+                '_url': f'/bench/{i}',
+                }) for i in range(number)]
+
+
+def register(endpoints):
+    Pool.register(
+        BenchmarkSite,
+        BenchmarkComponent,
+        *endpoints,
+        module='voyager', type_='model')
+
+
+def setup_sites(endpoints, uris):
+    'Create a site for each route method and the URIs, return the site ids'
+    with Transaction().start(DB_NAME, 0) as transaction:
+        pool = Pool()
+        Site = pool.get('www.site')
+        VoyagerURI = pool.get('www.uri')
+        Model = pool.get('ir.model')
+
+        models = Model.search([
+                ('name', 'in', [e.__name__ for e in endpoints]),
+                ], order=[('id', 'ASC')])
+        endpoint_site, uri_site = Site.create([{
+                    'name': 'Benchmark Endpoint',
+                    'type': SITE_TYPE,
+                    'url': 'http://localhost/',
+                    'route_method': 'endpoint',
+                    }, {
+                    'name': 'Benchmark URI',
+                    'type': SITE_TYPE,
+                    'url': 'http://localhost/',
+                    'route_method': 'uri',
+                    }])
+        VoyagerURI.create([{
+                    'site': uri_site.id,
+                    'uri': f'/page/{i}',
+                    'endpoint': models[i % len(models)].id,
+                    } for i in range(uris)])
+        transaction.commit()
+        return endpoint_site.id, uri_site.id
+
+
+def run_scenario(app, paths, requests, warmup):
+    client = Client(app)
+    for path in paths[:warmup]:
+        client.get(path)
+
+    latencies, queries = [], []
+    start = time.perf_counter()
+    for i in range(requests):
+        path = paths[i % len(paths)]
+        request_start = time.perf_counter()
+        response = client.get(path)
+        latencies.append(time.perf_counter() - request_start)
+        if response.status_code >= 400:
+            raise RuntimeError(
+                f'{path} returned {response.status_code}')
+        match = QUERIES_RE.search(response.headers.get('Server-Timing', ''))
+        if match:
+            queries.append(int(match.group(1)))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'rps': round(requests / elapsed, 2),
+        'p50': round(percentile(latencies, 50) * 1000, 3),
+        'p99': round(percentile(latencies, 99) * 1000, 3),
+        'queries': (round(sum(queries) / len(queries), 2)
+            if queries else None),
+        }
+
+
+def measure_import(module='trytond.modules.voyager', runs=5):
+    '''
+    Import module in new interpreters with -X importtime and return the best
+    cumulative time in milliseconds and the web modules it imported
+    '''
+    best, imported = None, set()
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            capture_output=True, text=True, check=True)
+        for line in process.stderr.splitlines():
+            match = IMPORT_TIME_RE.match(line)
+            if not match:
+                continue
+            cumulative, name = int(match.group(2)), match.group(3)
+            if name == module:
+                cumulative /= 1000
+                best = cumulative if best is None else min(best, cumulative)
+            elif name in WEB_MODULES:
+                imported.add(name)
+    return {
+        'import': best,
+        'web_modules': sorted(imported),
+        }
+
+
+def run(args):
+    from trytond.modules.voyager.app import VoyagerWSGI
+
+    SETTINGS['depth'] = args.depth
+    SETTINGS['width'] = args.width
+    endpoints = endpoint_classes(args.endpoints)
+    register(endpoints)
+    activate_module('voyager')
+    endpoint_site, uri_site = setup_sites(endpoints, args.uris)
+
+    # Use the request profile to count the queries of each request
+    profiling.PROFILE_ENABLED = True
+
+    app = VoyagerWSGI()
+    app.database = DB_NAME
+    app.site_type = SITE_TYPE
+    app.user_id = 1
+    app.start()
+
+    scenarios = {
+        'endpoint': (endpoint_site,
+            [e._url for e in endpoints]),
+        'uri': (uri_site,
+            [f'/page/{i}' for i in range(args.uris)]),
+        }
+    results = {}
+    for routing, (site_id, paths) in scenarios.items():
+        if not paths:
+            continue
+        for cache in (True, False):
+            voyager.CACHE_ENABLED = cache
+            voyager.CacheManager.clear()
+            app.site_id = site_id
+            name = f'{routing}-{"cached" if cache else "uncached"}'
+            results[name] = run_scenario(
+                app, paths, args.requests, args.warmup)
+    return results
+
+
+def report(results, baseline=None, tolerance=10):
+    'Print the results and return the scenarios slower than the baseline'
+    regressions = []
+    print(f'{"scenario":<20} {"req/s":>10} {"p50 ms":>10} {"p99 ms":>10} '
+        f'{"queries":>8}')
+    for name, result in results.items():
+        line = (f'{name:<20} {result["rps"]:>10} {result["p50"]:>10} '
+            f'{result["p99"]:>10} {result["queries"]!s:>8}')
+        previous = (baseline or {}).get(name)
+        if previous:
+            change = (result['rps'] - previous['rps']) / previous['rps'] * 100
+            line += f' {change:+.1f}% req/s'
+            if change < -tolerance:
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--endpoints', type=int, default=10)
+    parser.add_argument('--uris', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=2,
+        help="Levels of nested components")
+    parser.add_argument('--width', type=int, default=3,
+        help="Children of each component")
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--save', metavar='FILE',
+        help="Save the results as baseline")
+    parser.add_argument('--compare', metavar='FILE',
+        help="Compare the results with a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=10,
+        help="Percentage of req/s lost considered a regression")
+    parser.add_argument('--import-time', action='store_true',
+        help="Measure the import time of the module instead")
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        result = measure_import()
+        print(f'import {result["import"]} ms, web modules: '
+            f'{", ".join(result["web_modules"]) or "none"}')
+        return 0
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f,
+                indent=2, sort_keys=True)
+    if regressions:
+        print('Regressions: %s' % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool
+
+from trytond.modules.voyager.profiling import RequestProfile
+
+
+class QueryBudgetMixin:
+    '''
+    TestCase mixin to check the SQL queries executed to dispatch a request
+    against the _query_budget of its endpoint
+    '''
+
+    def dispatch_counting_queries(self, site, request, user_id=None,
+            web_prefix=None):
+        'Dispatch the request and return the response and its profile'
+        Site = Pool().get('www.site')
+        profile = RequestProfile.start(request, force=True)
+        try:
+            response = Site._dispatch(site.type, site.id, request,
+                user_id=user_id, web_prefix=web_prefix, profile=profile)
+        finally:
+            profile.stop()
+        return response, profile
+
+    def assertQueryBudget(self, site, request, budget=None, **kwargs):
+        '''
+        Fail if the request executes more queries than budget, by default the
+        _query_budget of the endpoint
+        '''
+        response, profile = self.dispatch_counting_queries(
+            site, request, **kwargs)
+        if budget is not None:
+            profile.budget = budget
+        if profile.over_budget:
+            phases = ', '.join(f'{name}: {queries}'
+                for name, _, queries in profile.phases)
+            self.fail(f'{profile.endpoint} executed {profile.queries.count} '
+                f'queries, over its budget of {profile.budget} ({phases})')
+        return response
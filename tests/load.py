@@ -0,0 +1,275 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Load generator for a voyager site served by a local ServerThread
+
+Concurrent clients replay a mix of paths (recorded in a file or generated)
+against the server and the throughput and latency percentiles are reported
+with the cache enabled and disabled.
+
+    python -m trytond.modules.voyager.tests.load DATABASE SITE_TYPE \\
+        --mix paths.txt --concurrency 16 --duration 30
+
+The mix file has a path per line, optionally preceded by its weight
+("10 /products"), so an access log can be turned into a mix with its
+path counts.
+
+Without an access log, --generate PAGES builds the mix from the endpoints
+without arguments and the sitemap URIs of the site, weighted by a Zipf
+distribution of their (shuffled) rank as real traffic concentrates on a few
+pages.
+'''
+import argparse
+import http.client
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from trytond.modules.voyager import voyager
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.voyager.profiling import percentile
+
+from .server import ServerThread
+
+
+def read_mix(filename):
+    'Return the paths and weights of a mix file'
+    paths, weights = [], []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            weight, _, path = line.partition(' ')
+            if path and weight.isdigit():
+                weights.append(int(weight))
+            else:
+                path = line
+                weights.append(1)
+            paths.append(path.strip())
+    return paths, weights
+
+
+def generate_mix(site, pages=100, skew=1.0, seed=None):
+    '''
+    Return the paths and weights of a mix of up to pages pages of site
+
+    The weight of the page at rank n is 1 / n ** skew.
+    '''
+    pool = Pool()
+    VoyagerURI = pool.get('www.uri')
+
+    web_map = site.get_site_info(None)[0]
+    paths = sorted({r.rule for r in web_map.iter_rules()
+            if not r.arguments and 'GET' in (r.methods or {'GET'})})
+    for entry in VoyagerURI.sitemap(site):
+        url = urlsplit(entry['loc'])
+        path = url.path + (f'?{url.query}' if url.query else '')
+        if path not in paths:
+            paths.append(path)
+    random.Random(seed).shuffle(paths)
+    paths = paths[:pages]
+    weights = [1 / rank ** skew for rank in range(1, len(paths) + 1)]
+    return paths, weights
+
+
+class LoadGenerator:
+    '''
+    Send requests from concurrent clients, each with its own keep-alive
+    connection and cookies, choosing the paths from the weighted mix
+    '''
+
+    def __init__(self, host, port, paths, weights=None, concurrency=10,
+            duration=None, requests=None, seed=None):
+        assert duration or requests, 'Set the duration or the requests'
+        self.host = host
+        self.port = port
+        self.paths = paths
+        self.weights = weights
+        self.concurrency = concurrency
+        self.duration = duration
+        self.requests = requests
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._sent = 0
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.bytes = 0
+
+    def _next(self, deadline):
+        with self._lock:
+            if self.requests is not None and self._sent >= self.requests:
+                return False
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            self._sent += 1
+            return True
+
+    def _client(self, number, deadline):
+        rng = random.Random(
+            None if self.seed is None else self.seed + number)
+        connection = http.client.HTTPConnection(self.host, self.port)
+        cookie = None
+        latencies, statuses, errors, size = [], Counter(), Counter(), 0
+        while self._next(deadline):
+            path, = rng.choices(self.paths, self.weights)
+            headers = {'Cookie': cookie} if cookie else {}
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                errors[type(e).__name__] += 1
+                connection.close()
+                connection = http.client.HTTPConnection(self.host, self.port)
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status] += 1
+            size += len(body)
+            set_cookie = response.getheader('Set-Cookie')
+            if set_cookie:
+                cookie = set_cookie.split(';', 1)[0]
+        connection.close()
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.statuses.update(statuses)
+            self.errors.update(errors)
+            self.bytes += size
+
+    def run(self):
+        deadline = None
+        if self.duration:
+            deadline = time.perf_counter() + self.duration
+        threads = [threading.Thread(target=self._client, args=(i, deadline))
+            for i in range(self.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return self.result(elapsed)
+
+    def result(self, elapsed):
+        latencies = [l * 1000 for l in self.latencies]
+        return {
+            'requests': len(latencies),
+            'elapsed': round(elapsed, 3),
+            'rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+            'statuses': dict(self.statuses),
+            'errors': dict(self.errors),
+            'bytes': self.bytes,
+            }
+
+
+def run_load(app, paths, weights=None, cache=True, **kwargs):
+    '''
+    Serve app in a ServerThread and run a LoadGenerator against it with the
+    voyager cache enabled or disabled
+    '''
+    cache_enabled = voyager.CACHE_ENABLED
+    voyager.CACHE_ENABLED = cache
+    voyager.CacheManager.clear()
+    server = ServerThread(app)
+    server.start()
+    try:
+        generator = LoadGenerator(server.host, server.port, paths, weights,
+            **kwargs)
+        return generator.run()
+    finally:
+        server.stop()
+        voyager.CACHE_ENABLED = cache_enabled
+
+
+def main(argv=None):
+    from trytond.modules.voyager.app import VoyagerWSGI
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('database')
+    parser.add_argument('site_type')
+    parser.add_argument('--site-id', type=int)
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--mix', metavar='FILE',
+        help="File with the paths to request")
+    parser.add_argument('--path', action='append', default=[],
+        help="Path to request, can be repeated")
+    parser.add_argument('--generate', type=int, metavar='PAGES',
+        help="Add a mix of PAGES pages of the site")
+    parser.add_argument('--skew', type=float, default=1.0,
+        help="Zipf exponent of the weights of the generated mix")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=None,
+        help="Seconds to run each scenario")
+    parser.add_argument('--requests', type=int, default=None,
+        help="Requests to send on each scenario")
+    parser.add_argument('--cache', choices=['on', 'off', 'both'],
+        default='both')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    paths, weights = list(args.path), [1] * len(args.path)
+    if args.mix:
+        mix_paths, mix_weights = read_mix(args.mix)
+        paths += mix_paths
+        weights += mix_weights
+    if not paths and not args.generate:
+        parser.error('Set the paths with --mix, --path or --generate')
+    if not args.duration and not args.requests:
+        args.duration = 10
+
+    app = VoyagerWSGI()
+    app.database = args.database
+    app.site_type = args.site_type
+    app.site_id = args.site_id
+    app.user_id = args.user_id
+    app.start()
+
+    if args.generate:
+        with Transaction().start(app.database, app.user_id, readonly=True):
+            domain = [('type', '=', args.site_type)]
+            if args.site_id:
+                domain.append(('id', '=', args.site_id))
+            sites = app.Site.search(domain, limit=1)
+            if not sites:
+                parser.error('Site not found')
+            mix_paths, mix_weights = generate_mix(sites[0], args.generate,
+                args.skew, args.seed)
+        if not paths and not mix_paths:
+            parser.error('The site has no pages to generate the mix')
+        if weights and mix_weights:
+            # Give the same share of the requests to the generated mix
+            scale = sum(weights) / sum(mix_weights)
+            mix_weights = [w * scale for w in mix_weights]
+        paths += mix_paths
+        weights += mix_weights
+
+    caches = {'on': [True], 'off': [False], 'both': [True, False]}[args.cache]
+    for cache in caches:
+        result = run_load(app, paths, weights, cache=cache,
+            concurrency=args.concurrency, duration=args.duration,
+            requests=args.requests, seed=args.seed)
+        if not result['requests']:
+            print(f'cache {"on" if cache else "off"}: no responses, '
+                f'errors {result["errors"]}')
+            continue
+        print(f'cache {"on" if cache else "off"}: '
+            f'{result["rps"]} req/s, p50 {result["p50"]:.2f} ms, '
+            f'p90 {result["p90"]:.2f} ms, p99 {result["p99"]:.2f} ms, '
+            f'max {result["max"]:.2f} ms, statuses {result["statuses"]}, '
+            f'errors {result["errors"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+
+class ServerThread(threading.Thread):
+    "Class that creates and manages a Tryton server in a new thread."
+    def __init__(self, app):
+        threading.Thread.__init__(self)
+
+        # When the system gets a '0' on the socket, it automatically finds a not-used port.
+        # SEE: https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
+        self.port = 0
+        self.host = 'localhost'
+
+        # Threaded is put to TRUE to ensure that the server is stopped.
+        # Werkzeug says: shutdown() must be called while serve_forever() is running in another thread, or it will deadlock.
+        self.server = make_server(self.host, self.port, app, threaded=True)
+
+        # Retrieve the port selected by the system
+        self.port = self.server.socket.getsockname()[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        if self.is_alive():
+            logger.info('Stopping server...')
+            self.server.shutdown()
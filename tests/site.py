@@ -0,0 +1,62 @@
+# This file is part voyager module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Site type with the endpoints used by the tests
+
+They are registered in the voyager module before it is activated:
+
+    site.register()
+    activate_module('voyager')
+'''
+from dominate.tags import div, p
+from trytond.pool import Pool, PoolMeta
+
+from trytond.modules.voyager.voyager import Endpoint
+
+SITE_TYPE = 'test'
+
+
+class TestSite(metaclass=PoolMeta):
+    __name__ = 'www.site'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.type.selection.append((SITE_TYPE, 'Test'))
+
+
+class TestPage(Endpoint):
+    'Test Page'
+    __name__ = 'www.test.page'
+    _type = SITE_TYPE
+    _url = '/page'
+    _query_budget = 20
+
+    def render(self):
+        return div(p('Page'), id='page')
+
+
+class TestFragments(Endpoint):
+    'Test Fragments'
+    __name__ = 'www.test.fragments'
+    _type = SITE_TYPE
+    _url = '/fragments'
+    _fragments = {'cart': 'render_cart'}
+    # The fragments rendered, to check the cache
+    rendered = []
+
+    def render(self):
+        return div(self.render_cart(), p('Page'), id='page')
+
+    def render_cart(self):
+        self.rendered.append('cart')
+        return div('Cart', id='cart')
+
+
+def register():
+    Pool.register(
+        TestSite,
+        TestPage,
+        TestFragments,
+        module='voyager', type_='model')
@@ -1,31 +1,312 @@
 # This file is part voyager module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from datetime import datetime, timezone
+import asyncio
+import base64
+import contextlib
+import gzip
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
 from types import MappingProxyType, SimpleNamespace
-from unittest.mock import Mock, patch
+from unittest.mock import DEFAULT, Mock, patch
 
+import jinja2
+from dominate.tags import br, div, p
+from dominate.util import raw
 from trytond.cache import Cache
+from trytond.exceptions import UserError
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.voyager.app import VoyagerWSGI
+from trytond.modules.voyager.asgi import VoyagerASGI, build_environ
+from trytond.modules.voyager.events import (
+    AsyncSubscription, TriggerBroker, format_event)
+from trytond.modules.voyager.middleware import (
+    IMMUTABLE_MAX_AGE, GzipMiddleware, StaticMiddleware, build_static,
+    static_url)
+from trytond.modules.voyager.profiling import (
+    ComponentStats, EndpointStats, QueryCounter, RequestProfile, percentile)
+from trytond.modules.voyager.tests.budget import QueryBudgetMixin
+from trytond.modules.voyager.tests.load import generate_mix
+from trytond.modules.voyager.serializer import iter_serialize, serialize
+from trytond.modules.voyager.tests.site import SITE_TYPE, register
 from trytond.modules.voyager.voyager import (
-    CacheManager, normalize_cache_value, VoyagerURI, ErrorRequest, Site)
+    CacheManager, Component, ErrorRequest, MarkdownRenderer, Metrics, Site,
+    VoyagerContext, VoyagerURI, VoyagerURIMixin, esi_secret,
+    normalize_cache_value, render_component)
 from trytond.tests.test_tryton import (
     ModuleTestCase, activate_module, with_transaction)
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.exceptions import NotFound
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import Request, Response
 
 
-class VoyagerTestCase(ModuleTestCase):
+class VoyagerTestCase(QueryBudgetMixin, ModuleTestCase):
     'Test Voyager module'
     module = 'voyager'
 
     @classmethod
     def setUpClass(cls):
+        register()
         super(VoyagerTestCase, cls).setUpClass()
         activate_module('sale')
         activate_module('web_shop')
 
+    def create_site(self, **values):
+        pool = Pool()
+        Site = pool.get('www.site')
+
+        site, = Site.create([{
+                    'name': 'Test',
+                    'type': SITE_TYPE,
+                    'url': 'https://example.com',
+                    **values,
+                    }])
+        return site
+
+    @with_transaction()
+    def test_uri_canonical_uri(self):
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        Model = pool.get('ir.model')
+        URI = pool.get('www.uri')
+
+        site = self.create_site()
+        langs = Lang.search([('code', 'in', ['en', 'ca', 'es'])])
+        Lang.write(langs, {'translatable': True})
+        langs = {l.code: l for l in langs}
+        en, ca, es = langs['en'], langs['ca'], langs['es']
+        endpoint, = Model.search([('model', '=', 'www.uri')])
+
+        def values(uri, language, **values):
+            return {
+                'site': site.id,
+                'uri': uri,
+                'endpoint': endpoint.id,
+                'language': language.id,
+                **values,
+                }
+        main, = URI.create([values('/about', en)])
+        related, inactive = URI.create([
+                    values('/ca/about', ca, main_uri=main.id),
+                    values('/es/about', es, main_uri=main.id, active=False),
+                    ])
+
+        def canonical(uris, language):
+            with Transaction().set_context(language=language):
+                return URI.get_canonical_uri(uris, 'canonical_uri')
+
+        self.assertEqual(canonical([main, related], 'ca'), {
+                main.id: related.id,
+                related.id: related.id,
+                })
+        self.assertEqual(canonical([related], 'en'), {related.id: main.id})
+        # Without a URI in the language the URIs are their own canonical
+        self.assertEqual(canonical([main, related], 'fr'), {
+                main.id: main.id,
+                related.id: related.id,
+                })
+        # The inactive URIs are never canonical
+        self.assertEqual(canonical([main, inactive], 'es'), {
+                main.id: main.id,
+                inactive.id: inactive.id,
+                })
+
+    @with_transaction()
+    def test_menu_check_site(self):
+        pool = Pool()
+        Menu = pool.get('www.menu')
+
+        site = self.create_site()
+        other_site = self.create_site(name='Other')
+
+        # A valid tree
+        root, = Menu.create([{
+                    'name': 'Root',
+                    'site': site.id,
+                    'menus': [('create', [{
+                                    'name': 'Child',
+                                    'site': site.id,
+                                    'menus': [('create', [{
+                                                    'name': 'Grandchild',
+                                                    'site': site.id,
+                                                    }])],
+                                    }])],
+                    }])
+        self.assertEqual(len(Menu.search([('site', '=', site.id)])), 3)
+
+        # A child of another site
+        with self.assertRaises(UserError):
+            Menu.create([{
+                        'name': 'Other',
+                        'site': other_site.id,
+                        'parent': root.id,
+                        }])
+
+        # A parent moved to another site than its children
+        with self.assertRaises(UserError):
+            Menu.write([root], {'site': other_site.id})
+
+    @with_transaction()
+    def test_session_clean_expired(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+        Session = pool.get('www.session')
+        transaction = Transaction()
+
+        site = self.create_site()
+        now = datetime.now()
+
+        def create_sessions(prefix, count, expiration_date):
+            return Session.create([{
+                        'site': site.id,
+                        'session_id': f'{prefix}{i}',
+                        'expiration_date': expiration_date,
+                        } for i in range(count)])
+        expired = create_sessions('expired', 5, now - timedelta(hours=1))
+        valid, = create_sessions('valid', 1, now + timedelta(hours=1))
+
+        company = create_company()
+        with set_company(company):
+            party, = Party.create([{'name': 'Customer'}])
+            Sale.create([{
+                        'party': party.id,
+                        'session': expired[0].id,
+                        }])
+
+        with patch.object(transaction, 'commit') as commit:
+            # The session of the sale is kept, the others fill two batches
+            self.assertEqual(Session.clean_expired(batch_size=2), 4)
+            self.assertEqual(commit.call_count, 2)
+
+            # The last batch is not full
+            create_sessions('other', 3, now - timedelta(hours=1))
+            commit.reset_mock()
+            self.assertEqual(Session.clean_expired(batch_size=2), 3)
+            self.assertEqual(commit.call_count, 2)
+
+        self.assertEqual(Session.search([], order=[('id', 'ASC')]),
+            [expired[0], valid])
+
+    @with_transaction()
+    def test_markdown_cache_store_clean(self):
+        pool = Pool()
+        MarkdownCache = pool.get('www.markdown.cache')
+
+        site = self.create_site(metadescription='**Voyager**')
+        other = self.create_site(metadescription='Other')
+        digest = MarkdownRenderer.digest('**Voyager**')
+        self.assertIsNone(MarkdownCache.get_html(digest))
+
+        MarkdownCache.store([site, other], ['metadescription'])
+        self.assertEqual(MarkdownCache.get_html(digest),
+            '<p><strong>Voyager</strong></p>')
+        # Storing again replaces the previous html
+        MarkdownCache.store([site], ['metadescription'])
+        self.assertEqual(len(MarkdownCache.search([])), 2)
+
+        MarkdownCache.clean([site], ['title'])
+        self.assertEqual(len(MarkdownCache.search([])), 2)
+        MarkdownCache.clean([site])
+        self.assertIsNone(MarkdownCache.get_html(digest))
+        self.assertIsNotNone(
+            MarkdownCache.get_html(MarkdownRenderer.digest('Other')))
+
+    @with_transaction()
+    def test_rendermarkdown_skips_unused_cache(self):
+        pool = Pool()
+        MarkdownCache = pool.get('www.markdown.cache')
+        Site = pool.get('www.site')
+
+        self.assertFalse(MarkdownCache.is_used())
+        MarkdownRenderer.clear()
+        with patch.object(MarkdownCache, 'get_html') as get_html:
+            self.assertEqual(Site().rendermarkdown('*text*'),
+                '<p><em>text</em></p>')
+            get_html.assert_not_called()
+
+            with patch.object(MarkdownCache, '_used', True):
+                Site().rendermarkdown('*other*')
+            get_html.assert_called_once_with(
+                MarkdownRenderer.digest('*other*'))
+        MarkdownRenderer.clear()
+
+    @with_transaction()
+    def test_menu_tree_resolves_hrefs_at_once(self):
+        pool = Pool()
+        Menu = pool.get('www.menu')
+        Model = pool.get('ir.model')
+        URI = pool.get('www.uri')
+
+        test_site = self.create_site()
+        endpoint, = Model.search([('model', '=', 'www.test.page')])
+        root, = Menu.create([{
+                    'name': 'Root',
+                    'site': test_site.id,
+                    'type': 'external',
+                    'url': 'https://example.org',
+                    }])
+
+        def create_menus(count):
+            uris = URI.create([{
+                        'site': test_site.id,
+                        'uri': f'/page/{i}',
+                        'endpoint': endpoint.id,
+                        } for i in range(count)])
+            Menu.create([{
+                        'name': uri.uri,
+                        'site': test_site.id,
+                        'parent': root.id,
+                        'type': 'internal',
+                        'uri': uri.id,
+                        } for uri in uris])
+
+        _, adapter, endpoint_args, _ = test_site.get_site_info(None)
+        context = VoyagerContext(site=test_site, adapter=adapter,
+            endpoint_args=endpoint_args)
+
+        def get_tree():
+            Menu._tree_cache.clear()
+            with Transaction().set_context(voyager_context=context):
+                with QueryCounter() as counter:
+                    tree = Menu.get_tree(test_site)
+            return tree, counter.count
+
+        create_menus(2)
+        tree, queries = get_tree()
+        item, = tree
+        self.assertEqual(
+            (item.name, item.href), ('Root', 'https://example.org'))
+        self.assertEqual([(c.name, c.href) for c in item.children], [
+                ('/page/0', '/page'),
+                ('/page/1', '/page'),
+                ])
+
+        # The queries do not depend on the number of menus
+        Menu.delete(Menu.search([('parent', '=', root.id)]))
+        create_menus(5)
+        tree, more_queries = get_tree()
+        self.assertEqual(len(tree[0].children), 5)
+        self.assertEqual(more_queries, queries)
+
+    @with_transaction()
+    def test_site_modification_clears_menu_trees(self):
+        pool = Pool()
+        Menu = pool.get('www.menu')
+        Site = pool.get('www.site')
+
+        test_site = self.create_site()
+        Menu._tree_cache.set((test_site.id, None, None), ())
+        Site.write([test_site], {'route_method': 'uri'})
+        self.assertIsNone(Menu._tree_cache.get((test_site.id, None, None)))
+
     def test_sitemap_groups_related_uris(self):
         site = SimpleNamespace(url='https://example.com')
         write_date = datetime(2026, 4, 14, 8, 30, tzinfo=timezone.utc)
@@ -119,6 +400,538 @@ class VoyagerTestCase(ModuleTestCase):
 
         cache.clear.assert_called_once_with()
 
+    @with_transaction()
+    def test_cache_manager_context_by_language(self):
+        User = Pool().get('res.user')
+        CacheManager.clear()
+        try:
+            context = dict(CacheManager.get_context(1, 1, 'ca'))
+            self.assertEqual(context['language'], 'ca')
+            with patch.object(User, '_get_preferences') as get_preferences:
+                self.assertEqual(
+                    dict(CacheManager.get_context(1, 1, 'ca')), context)
+                get_preferences.assert_not_called()
+            self.assertEqual(
+                dict(CacheManager.get_context(1, 1, 'es'))['language'], 'es')
+
+            CacheManager.clear()
+            with patch.object(User, '_get_preferences',
+                    return_value={}) as get_preferences:
+                CacheManager.get_context(1, 1, 'ca')
+                get_preferences.assert_called_once()
+        finally:
+            CacheManager.clear()
+
+    def test_cache_manager_evict_database(self):
+        caches = CacheManager.caches
+        CacheManager.caches = {('db1', 1): Mock(), ('db2', 1): Mock()}
+        try:
+            CacheManager.evict('db1')
+            self.assertEqual(list(CacheManager.caches), [('db2', 1)])
+        finally:
+            CacheManager.caches = caches
+
+    @with_transaction()
+    def test_wsgi_warmup_multisite(self):
+        pool = Pool()
+        Site = pool.get('www.site')
+        transaction = Transaction()
+
+        shop = self.create_site(url='https://shop.example.com')
+        blog = self.create_site(url='https://example.com/blog')
+        app = VoyagerWSGI()
+        app.pool, app.Site = pool, Site
+        app.database = transaction.database.name
+        app.site_type = app.site_id = None
+        app.user_id = transaction.user
+        name = 'voyager/warmup.html'
+        key = (app.database, 'www.test.page', name, shop.id)
+        Component._templates.pop(key, None)
+
+        with contextlib.ExitStack() as stack:
+            # The warmup runs in the transaction of the test
+            stack.enter_context(patch.object(transaction, 'start',
+                    return_value=contextlib.nullcontext(transaction)))
+            stack.enter_context(patch.object(transaction, 'rollback'))
+            stack.enter_context(patch('trytond.modules.voyager.app.gc'))
+            stack.enter_context(patch.object(Component, 'template_names',
+                    return_value=[name]))
+            stack.enter_context(patch.object(Component, 'load_template',
+                    return_value='<p>{{ 1 + 1 }}</p>'))
+            dispatch = stack.enter_context(patch.object(Site, 'dispatch'))
+            app.warmup(['/', 'https://shop.example.com/page',
+                    'https://unknown.example.com/'])
+
+        self.assertEqual(Component._templates.pop(key).render(), '<p>2</p>')
+        # The unknown host is skipped
+        self.assertCountEqual([(
+                    c.args[0], c.args[1], c.args[2].host, c.args[2].path,
+                    c.kwargs['web_prefix'])
+                for c in dispatch.call_args_list], [
+                (SITE_TYPE, shop.id, 'shop.example.com', '/', None),
+                (SITE_TYPE, blog.id, 'example.com', '/blog/', '/blog'),
+                (SITE_TYPE, shop.id, 'shop.example.com', '/page', None),
+                ])
+
+    def test_wsgi_pools_lru_eviction(self):
+        app = VoyagerWSGI()
+        app.database = 'main'
+        app.max_pools = 2
+        with patch.multiple('trytond.modules.voyager.app', Pool=DEFAULT,
+                Cache=DEFAULT, backend=DEFAULT) as mocks:
+            Pool_, Cache_, backend_ = (
+                mocks['Pool'], mocks['Cache'], mocks['backend'])
+            with patch.object(CacheManager, 'evict') as evict:
+                Pool_.side_effect = lambda database: Mock(name=database)
+                database_b = Mock()
+                backend_.Database._databases = {
+                    os.getpid(): {'b': database_b},
+                    }
+                pool_a = app.get_pool('a')
+                app.get_pool('b')
+                self.assertIs(app.get_pool('a'), pool_a)
+                self.assertEqual(Pool_.call_count, 2)
+
+                # b is the least recently used
+                app.get_pool('c')
+                self.assertEqual(list(app.pools), ['a', 'c'])
+                Pool_.stop.assert_called_once_with('b')
+                Cache_.drop.assert_called_once_with('b')
+                evict.assert_called_once_with('b')
+                database_b.close.assert_called_once_with()
+                backend_.Database.assert_not_called()
+
+                # The pools serving requests are kept
+                app.get_pool('a', acquire=True)
+                app.get_pool('c', acquire=True)
+                app.get_pool('d')
+                self.assertEqual(list(app.pools), ['a', 'c', 'd'])
+                app.release_pool('a')
+                app.release_pool('c')
+                app.get_pool('e')
+                self.assertEqual(list(app.pools), ['d', 'e'])
+                self.assertFalse(app._active)
+
+                # A failed close does not break the request
+                database_d = Mock()
+                database_d.close.side_effect = Exception('closed')
+                backend_.Database._databases[os.getpid()]['d'] = database_d
+                with self.assertLogs('trytond.modules.voyager.app',
+                        'WARNING'):
+                    app.get_pool('f')
+                self.assertEqual(list(app.pools), ['e', 'f'])
+                database_d.close.assert_called_once_with()
+
+    def test_wsgi_pools_acquire_concurrently(self):
+        app = VoyagerWSGI()
+        app.database = 'main'
+        started = threading.Barrier(4)
+
+        def acquire():
+            started.wait()
+            app.get_pool('a', acquire=True)
+
+        with patch('trytond.modules.voyager.app.Pool') as Pool_:
+            Pool_.side_effect = lambda database: Mock(name=database)
+            threads = [threading.Thread(target=acquire) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(Pool_.call_count, 1)
+            self.assertEqual(app._active['a'], 4)
+
+            for _ in range(4):
+                app.release_pool('a')
+            self.assertNotIn('a', app._active)
+
+            # A pool that fails to initialize is not kept acquired
+            Pool_.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                app.get_pool('b', acquire=True)
+            self.assertNotIn('b', app._active)
+            self.assertNotIn('b', app.pools)
+
+    def test_wsgi_streamed_response_transaction(self):
+        app = VoyagerWSGI()
+        app.database = 'main'
+        app.user_id = 1
+        app.site_id = 1
+        Site = Mock()
+        app.pools['main'] = SimpleNamespace(get=lambda name: Site)
+        environ = EnvironBuilder(path='/').get_environ()
+        with patch('trytond.modules.voyager.app.Transaction') as Transaction_:
+            transaction = Transaction_.return_value.start.return_value
+
+            # The transaction is committed once the stream is closed
+            response = Response(iter([b'a', b'b']))
+            response.keep_transaction = True
+            Site.dispatch.return_value = response
+            response = app.dispatch_request(Request(environ))
+            transaction.stop.assert_not_called()
+            body = response(environ, lambda status, headers: None)
+            self.assertEqual(b''.join(body), b'ab')
+            body.close()
+            transaction.stop.assert_called_once_with(True)
+
+            # The transaction is rolled back if the dispatch fails
+            transaction.reset_mock()
+            Site.dispatch.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                app.dispatch_request(Request(environ))
+            transaction.stop.assert_called_once_with(False)
+        self.assertFalse(app._active)
+
+    @with_transaction()
+    def test_stream_response_rollback_on_error(self):
+        pool = Pool()
+        Site = pool.get('www.site')
+        transaction = Transaction()
+
+        def stream():
+            yield div('first')
+            raise ValueError
+
+        component = SimpleNamespace(__name__='www.test', stream=stream)
+        with patch.object(transaction, 'rollback') as rollback:
+            chunks = Site._stream_response(component, {}, transaction.user)
+            self.assertEqual(next(chunks), '<div>first</div>')
+            rollback.assert_not_called()
+            # The response is truncated and the changes are discarded
+            self.assertEqual(list(chunks), [])
+            rollback.assert_called_once_with()
+
+    @with_transaction()
+    def test_session_token_is_signed(self):
+        pool = Pool()
+        Session = pool.get('www.session')
+
+        session = Session(session_id='abc',
+            expiration_date=datetime.now() + timedelta(hours=1))
+        with patch('trytond.modules.voyager.voyager.SESSION_SECRET',
+                'secret'):
+            token = session.token
+            self.assertEqual(Session.session_id_from_token(token), 'abc')
+            self.assertIsNone(
+                Session.session_id_from_token('abd' + token[3:]))
+            self.assertIsNone(Session.session_id_from_token('abc'))
+            self.assertIsNone(Session.session_id_from_token('a.b.\xe9'))
+            self.assertIsNone(Session.session_id_from_token('a.b.\udce9'))
+
+            session.expiration_date = datetime.now() - timedelta(hours=1)
+            self.assertIsNone(Session.session_id_from_token(session.token))
+        self.assertEqual(session.token, 'abc')
+
+    @with_transaction()
+    def test_dispatch_htmx_fragment(self):
+        pool = Pool()
+        Site = pool.get('www.site')
+        Fragments = pool.get('www.test.fragments')
+
+        test_site = self.create_site()
+
+        def dispatch(target=None):
+            headers = {'HX-Request': 'true'}
+            if target:
+                headers['HX-Target'] = target
+            request = EnvironBuilder(path='/fragments', base_url=test_site.url,
+                headers=headers).get_request()
+            return Site._dispatch(test_site.type, test_site.id, request,
+                user_id=1)
+
+        del Fragments.rendered[:]
+        CacheManager.clear()
+        with patch('trytond.modules.voyager.voyager.CACHE_ENABLED', True):
+            try:
+                # Only the fragment is rendered
+                response = dispatch('cart')
+                self.assertEqual(response.get_data(as_text=True),
+                    '<div id="cart">Cart</div>')
+                self.assertIn('HX-Target', response.vary)
+                self.assertEqual(Fragments.rendered, ['cart'])
+
+                # The fragment is cached apart from the page
+                dispatch('cart')
+                self.assertEqual(Fragments.rendered, ['cart'])
+                CacheManager.clear()
+                dispatch('cart')
+                self.assertEqual(Fragments.rendered, ['cart', 'cart'])
+
+                # The unknown targets get the full page
+                for target in ['unknown', None]:
+                    response = dispatch(target)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response.get_data(as_text=True),
+                        '<div id="page"><div id="cart">Cart</div>'
+                        '<p>Page</p></div>')
+            finally:
+                CacheManager.clear()
+
+    @with_transaction()
+    def test_load_generate_mix(self):
+        test_site = self.create_site()
+
+        paths, weights = generate_mix(test_site, seed=1)
+        self.assertTrue({'/page', '/fragments'} <= set(paths))
+        self.assertEqual(len(weights), len(paths))
+        self.assertEqual(weights[:2], [1, 1 / 2])
+        self.assertEqual(generate_mix(test_site, seed=1), (paths, weights))
+
+        paths, weights = generate_mix(test_site, pages=1, skew=2)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(weights, [1])
+
+    def test_voyager_context_htmx_headers(self):
+        request = SimpleNamespace(headers={
+                'HX-Request': 'true',
+                'HX-Target': 'cart',
+                })
+        context = VoyagerContext(request=request)
+        self.assertTrue(context.htmx)
+        self.assertEqual(context.hx_target, 'cart')
+
+        context = VoyagerContext(request=SimpleNamespace(headers={
+                    'HX-Target': 'cart',
+                    }))
+        self.assertFalse(context.htmx)
+        self.assertIsNone(context.hx_target)
+
+    def test_esi_secret(self):
+        with patch('trytond.modules.voyager.voyager.ESI_SECRET', 'secret'):
+            self.assertEqual(esi_secret(), 'secret')
+
+        with patch('trytond.modules.voyager.voyager.ESI_SECRET', None):
+            with self.assertLogs('trytond.modules.voyager.voyager',
+                    'WARNING') as logs:
+                secret = esi_secret()
+                self.assertEqual(esi_secret(), secret)
+            self.assertTrue(secret)
+            self.assertEqual(len(logs.records), 1)
+            self.assertIn('esi_secret', logs.output[0])
+
+    def test_component_assemble_replaces_placeholders(self):
+        class Child(Component):
+            __name__ = 'www.child'
+            instances = []
+
+            def __init__(self, **kwargs):
+                self.kwargs = kwargs
+                self.instances.append(self)
+
+            def create_tag(self, esi=True):
+                self._tag = raw('<b>child</b>')
+
+        def placeholder(name, values, signature=None):
+            data = base64.urlsafe_b64encode(
+                json.dumps([name, values]).encode()).decode()
+            signature = signature or Component.esi_signature(data)
+            return f'<!--voyager-esi:{data}.{signature}-->'
+
+        pool = {'www.child': Child, 'res.user': Mock()}
+        with patch('trytond.modules.voyager.voyager.Pool',
+                return_value=pool):
+            html = Component.assemble(
+                f'<div>{placeholder("www.child", {"product": 1})}</div>')
+            self.assertEqual(html, '<div><b>child</b></div>')
+            child, = Child.instances
+            self.assertEqual(child.kwargs, {'render': False, 'product': 1})
+
+            # Forged, unknown and non component placeholders are removed
+            for forged in [
+                    placeholder('www.child', {'product': 2}, 'forged'),
+                    placeholder('www.unknown', {}),
+                    placeholder('res.user', {}),
+                    ]:
+                self.assertEqual(Component.assemble(f'<p>{forged}</p>'),
+                    '<p></p>')
+        self.assertEqual(len(Child.instances), 1)
+
+    def test_render_component_lazy_in_template(self):
+        component = Mock()
+        component.render_lazy.return_value = div(hx_get='/lazy',
+            hx_trigger='load')
+        env = jinja2.Environment(autoescape=True)
+        env.globals['render_component'] = render_component
+        template = env.from_string(
+            "<main>{{ render_component('www.lazy', lazy=True) }}</main>")
+
+        with patch('trytond.modules.voyager.voyager.Pool',
+                return_value={'www.lazy': Mock(return_value=component)}):
+            html = template.render()
+
+        self.assertEqual(html,
+            '<main><div hx-get="/lazy" hx-trigger="load"></div></main>')
+
+    def test_serialize_maps_htmx_attributes(self):
+        node = div(hx_get='/cart', sse_connect='/events', id='cart')
+        with node:
+            p('hx_get <b>')
+            br()
+            raw('<!--comment-->')
+
+        html = serialize(node)
+        self.assertEqual(html, '<div hx-get="/cart" sse-connect="/events" '
+            'id="cart"><p>hx_get &lt;b&gt;</p><br><!--comment--></div>')
+        self.assertEqual(''.join(iter_serialize(node, chunk_size=10)), html)
+
+    def test_serialize_matches_dominate_render(self):
+        node = div(id='menu', title='Fish "&" chips')
+        with node:
+            p('Fish & chips <b> "quoted"')
+            p(raw('<b>&amp;</b>'), ' & more')
+            br()
+
+        self.assertEqual(serialize(node), node.render(pretty=False))
+        self.assertNotIn('&amp;lt;', serialize(node))
+
+    def test_gzip_middleware_compresses_large_responses(self):
+        body = '<p>voyager</p>' * 200
+        app = GzipMiddleware(Response(body, content_type='text/html'),
+            minimum_size=1024)
+        client = Client(app)
+
+        response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data).decode(), body)
+
+        response = client.get('/')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(as_text=True), body)
+
+        small = GzipMiddleware(Response('<p>voyager</p>',
+                content_type='text/html'), minimum_size=1024)
+        response = Client(small).get('/',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def create_static(self, files):
+        'Return a temporary static folder with the files'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name, content in files.items():
+            path = os.path.join(directory.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+        return directory.name
+
+    def test_build_static(self):
+        css = 'body { color: red; }' * 100
+        directory = self.create_static({
+                'css/site.css': css,
+                'logo.png': 'png',
+                })
+
+        manifest = build_static(directory)
+        self.assertEqual(set(manifest), {'css/site.css', 'logo.png'})
+        self.assertRegex(manifest['css/site.css'],
+            r'^css/site\.[0-9a-f]{12}\.css$')
+        self.assertRegex(manifest['logo.png'], r'^logo\.[0-9a-f]{12}\.png$')
+        with open(os.path.join(directory, manifest['css/site.css'])) as f:
+            self.assertEqual(f.read(), css)
+        for name in ['css/site.css', manifest['css/site.css']]:
+            with gzip.open(os.path.join(directory, name + '.gz'), 'rt') as f:
+                self.assertEqual(f.read(), css)
+        self.assertFalse(os.path.exists(
+                os.path.join(directory, manifest['logo.png'] + '.gz')))
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+
+        # The built files are not hashed again
+        self.assertEqual(build_static(directory), manifest)
+
+        # The hash changes with the content
+        with open(os.path.join(directory, 'css/site.css'), 'w') as f:
+            f.write('body { color: blue; }')
+        self.assertNotEqual(build_static(directory)['css/site.css'],
+            manifest['css/site.css'])
+
+    def test_static_url(self):
+        directory = self.create_static({'js/app.js': 'app();'})
+
+        self.assertEqual(static_url('js/app.js', directory),
+            '/static/js/app.js')
+        manifest = build_static(directory)
+        self.assertEqual(static_url('js/app.js', directory),
+            '/static/' + manifest['js/app.js'])
+        self.assertEqual(static_url('js/app.js', directory, prefix='/assets'),
+            '/assets/' + manifest['js/app.js'])
+        self.assertEqual(static_url('missing.js', directory),
+            '/static/missing.js')
+
+    def test_static_middleware(self):
+        css = 'body { color: red; }' * 100
+        root = self.create_static({
+                'static/site.css': css,
+                'static/css/.keep': '',
+                'secret.txt': 'secret',
+                })
+        directory = os.path.join(root, 'static')
+        manifest = build_static(directory)
+        app = StaticMiddleware(Response('app', content_type='text/plain'),
+            directory, max_age=60)
+        client = Client(app)
+
+        response = client.get('/static/site.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), css)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.cache_control.max_age, 60)
+        self.assertFalse(response.cache_control.immutable)
+        self.assertIn('Accept-Encoding', response.vary)
+
+        # The precompressed sibling is sent to the clients that accept it
+        response = client.get('/static/site.css',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data).decode(), css)
+
+        # The hashed files are cached for ever
+        response = client.get('/static/' + manifest['site.css'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cache_control.max_age, IMMUTABLE_MAX_AGE)
+        self.assertTrue(response.cache_control.immutable)
+
+        # Conditional requests are answered with 304
+        etag = response.headers['ETag']
+        response = client.get('/static/' + manifest['site.css'],
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # The paths outside the folder and the missing files go to the app
+        for path in ['/static/../secret.txt', '/static/%2e%2e/secret.txt',
+                '/static/missing.css', '/static/css', '/other.css']:
+            response = client.get(path)
+            self.assertEqual(response.get_data(as_text=True), 'app', path)
+
+    @with_transaction()
+    def test_match_site_by_host_and_prefix(self):
+        sites = [
+            SimpleNamespace(id=1, type='shop', url='https://example.com'),
+            SimpleNamespace(id=2, type='blog',
+                url='https://example.com/blog/'),
+            SimpleNamespace(id=3, type='shop', url='https://example.org'),
+            ]
+        request = lambda host, path: SimpleNamespace(host=host, path=path)
+        Site._site_hosts_cache.clear()
+        try:
+            with patch.object(Site, 'search', return_value=sites):
+                self.assertEqual(Site.match_site(
+                        request('example.com', '/blog/post')),
+                    (2, 'blog', '/blog'))
+                self.assertEqual(Site.match_site(
+                        request('Example.com', '/blogs')),
+                    (1, 'shop', None))
+                self.assertEqual(Site.match_site(
+                        request('example.org', '/')),
+                    (3, 'shop', None))
+                self.assertIsNone(Site.match_site(
+                        request('example.net', '/')))
+        finally:
+            Site._site_hosts_cache.clear()
+
     def test_error_request_keeps_original_request(self):
         request = SimpleNamespace(
             path='/missing',
@@ -166,4 +979,295 @@ class VoyagerTestCase(ModuleTestCase):
                 'status': 404,
                 })
 
+    def test_markdown_renderer_shifts_headers_and_memoizes(self):
+        MarkdownRenderer.clear()
+        text = '# Title\n\n###### Small\n\n---'
+
+        html = MarkdownRenderer.render(text, start_header=3)
+        self.assertIn('<h3 id="title">Title</h3>', html)
+        self.assertIn('<h6 id="small">Small</h6>', html)
+        self.assertIn('<hr />', html)
+        self.assertEqual(MarkdownRenderer.render(text, start_header=3), html)
+        self.assertIn('<h1', MarkdownRenderer.render(text))
+
+        stats = MarkdownRenderer.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+    def test_asgi_build_environ(self):
+        environ = build_environ({
+                'type': 'http',
+                'method': 'POST',
+                'path': '/càrrec',
+                'query_string': b'page=2',
+                'server': ('example.com', 443),
+                'scheme': 'https',
+                'headers': [
+                    (b'content-type', b'application/x-www-form-urlencoded'),
+                    (b'hx-request', b'true'),
+                    (b'accept', b'text/html'),
+                    (b'accept', b'*/*'),
+                    ],
+                }, b'foo=bar')
+
+        self.assertEqual(environ['REQUEST_METHOD'], 'POST')
+        self.assertEqual(
+            environ['PATH_INFO'].encode('latin-1').decode('utf-8'),
+            '/càrrec')
+        self.assertEqual(environ['QUERY_STRING'], 'page=2')
+        self.assertEqual(environ['SERVER_PORT'], '443')
+        self.assertEqual(environ['wsgi.url_scheme'], 'https')
+        self.assertEqual(
+            environ['CONTENT_TYPE'], 'application/x-www-form-urlencoded')
+        self.assertEqual(environ['HTTP_HX_REQUEST'], 'true')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html,*/*')
+        self.assertEqual(environ['wsgi.input'].read(), b'foo=bar')
+
+    def test_trigger_broker_streams_session_events(self):
+        subscription = TriggerBroker.subscribe('session-a')
+        other = TriggerBroker.subscribe('session-b')
+        stream = TriggerBroker.stream('session-a', subscription, timeout=60)
+        try:
+            self.assertTrue(next(stream).startswith('retry: '))
+            TriggerBroker.publish('cart-updated', ['session-a'], data='1\n2')
+            TriggerBroker.publish('stock-changed')
+            self.assertEqual(next(stream),
+                'event: cart-updated\ndata: 1\ndata: 2\n\n')
+            self.assertEqual(next(stream), format_event('stock-changed'))
+            self.assertEqual(other.get_nowait(), ('stock-changed', ''))
+        finally:
+            stream.close()
+            TriggerBroker.unsubscribe('session-b', other)
+        self.assertNotIn('session-a', TriggerBroker._subscribers)
+
+    def test_async_subscription_streams_on_event_loop(self):
+        async def run():
+            subscription = AsyncSubscription(asyncio.get_running_loop())
+            TriggerBroker.subscribe('session-a', subscription)
+            stream = subscription.stream(heartbeat=0.01, timeout=60)
+            try:
+                self.assertTrue((await stream.__anext__()).startswith(
+                        'retry: '))
+                self.assertEqual(await stream.__anext__(), ': heartbeat\n\n')
+                # Published from a worker thread
+                thread = threading.Thread(target=TriggerBroker.publish,
+                    args=('cart-updated', ['session-a']))
+                thread.start()
+                thread.join()
+                event = await stream.__anext__()
+                while event == ': heartbeat\n\n':
+                    event = await stream.__anext__()
+                self.assertEqual(event, format_event('cart-updated'))
+            finally:
+                await stream.aclose()
+                TriggerBroker.unsubscribe('session-a', subscription)
+
+        asyncio.run(run())
+        self.assertNotIn('session-a', TriggerBroker._subscribers)
+
+    def test_asgi_serves_event_stream(self):
+        def wsgi_app(environ, start_response):
+            # Like EventStream, with the worst case of a Content-Length
+            environ['voyager.event_stream'] = 'session-asgi'
+            response = Response('', content_type='text/event-stream')
+            return response(environ, start_response)
+
+        application = VoyagerASGI(wsgi_app, max_workers=1)
+        sent = []
+
+        async def run():
+            disconnect = asyncio.Event()
+            requests = [{'type': 'http.request', 'body': b''}]
+
+            async def receive():
+                if requests:
+                    return requests.pop()
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                body = message.get('body', b'')
+                if body.startswith(b'retry: '):
+                    threading.Thread(target=TriggerBroker.publish,
+                        args=('cart-updated', ['session-asgi'])).start()
+                elif body.startswith(b'event: '):
+                    disconnect.set()
+
+            await asyncio.wait_for(application({
+                        'type': 'http',
+                        'method': 'GET',
+                        'path': '/voyager/events',
+                        'headers': [],
+                        }, receive, send), 10)
+
+        try:
+            asyncio.run(run())
+        finally:
+            application.shutdown()
+
+        start = sent[0]
+        self.assertEqual(start['type'], 'http.response.start')
+        self.assertEqual(start['status'], 200)
+        headers = dict(start['headers'])
+        self.assertEqual(headers[b'content-type'], b'text/event-stream')
+        self.assertNotIn(b'content-length', headers)
+        bodies = [m['body'] for m in sent[1:]]
+        self.assertTrue(bodies[0].startswith(b'retry: '))
+        self.assertEqual(bodies[-1], format_event('cart-updated').encode())
+        self.assertNotIn('session-asgi', TriggerBroker._subscribers)
+
+    def test_trigger_broker_caps_blocking_streams(self):
+        self.assertTrue(TriggerBroker.acquire_stream(maximum=1))
+        try:
+            self.assertFalse(TriggerBroker.acquire_stream(maximum=1))
+        finally:
+            TriggerBroker.release_stream()
+        self.assertTrue(TriggerBroker.acquire_stream(maximum=1))
+        TriggerBroker.release_stream()
+
+    def test_query_budget_fails_over_budget(self):
+        class TestCase(QueryBudgetMixin, unittest.TestCase):
+            def runTest(self):
+                pass
+
+        profile = RequestProfile()
+        profile.endpoint = 'www.test'
+        profile.budget = 2
+        profile.queries.count = 3
+        profile.phases = [('routing', 0.001, 1), ('render', 0.002, 2)]
+        case = TestCase()
+        with patch.object(case, 'dispatch_counting_queries',
+                return_value=('response', profile)):
+            with self.assertRaises(case.failureException) as cm:
+                case.assertQueryBudget(None, None)
+            self.assertEqual(str(cm.exception),
+                'www.test executed 3 queries, over its budget of 2 '
+                '(routing: 1, render: 2)')
+            self.assertEqual(
+                case.assertQueryBudget(None, None, budget=3), 'response')
+
+    def test_component_stats_sample_size(self):
+        name = 'www.test.sample'
+        self.assertTrue(ComponentStats.sample_size(name, sample=2))
+        ComponentStats.rendered(name, 0.001, cached=True, size=10)
+        self.assertFalse(ComponentStats.sample_size(name, sample=2))
+        ComponentStats.rendered(name, 0.001, cached=True)
+        self.assertTrue(ComponentStats.sample_size(name, sample=2))
+        self.assertEqual(ComponentStats.summary()[name]['cached_size'], 10)
+
+    def test_metrics_authorization(self):
+        def endpoint(system_user=None, authorization=None):
+            headers = {}
+            if authorization is not None:
+                headers['Authorization'] = authorization
+            return SimpleNamespace(
+                session=SimpleNamespace(system_user=system_user),
+                context={'voyager_context': SimpleNamespace(
+                        request=SimpleNamespace(headers=headers))})
+
+        with patch('trytond.modules.voyager.voyager.METRICS_TOKEN', None):
+            self.assertTrue(Metrics.authorized(endpoint(system_user=1)))
+            self.assertFalse(Metrics.authorized(endpoint()))
+            self.assertFalse(
+                Metrics.authorized(endpoint(authorization='Bearer ')))
+        with patch('trytond.modules.voyager.voyager.METRICS_TOKEN', 'secret'):
+            self.assertTrue(
+                Metrics.authorized(endpoint(authorization='Bearer secret')))
+            self.assertFalse(
+                Metrics.authorized(endpoint(authorization='Bearer other')))
+            self.assertFalse(
+                Metrics.authorized(endpoint(authorization='Bearer \udce9')))
+
+    @with_transaction()
+    def test_query_budget_of_dispatched_request(self):
+        test_site = self.create_site()
+        request = EnvironBuilder(path='/page',
+            base_url=test_site.url).get_request()
+
+        response, profile = self.dispatch_counting_queries(test_site, request,
+            user_id=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(profile.endpoint, 'www.test.page')
+        self.assertEqual(profile.budget, 20)
+        self.assertGreater(profile.queries.count, 0)
+
+        self.assertQueryBudget(test_site, request, user_id=1)
+        with self.assertRaises(self.failureException):
+            self.assertQueryBudget(test_site, request, budget=0, user_id=1)
+
+    def test_endpoint_stats_percentiles(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+
+        EndpointStats.clear()
+        for i in range(1, 11):
+            EndpointStats.add('www.test', i / 1000, i % 3)
+        summary = EndpointStats.summary()['www.test']
+        self.assertEqual(summary['count'], 10)
+        self.assertEqual(summary['p50'], 5)
+        self.assertEqual(summary['p99'], 10)
+        self.assertEqual(summary['queries_max'], 2)
+
+    @with_transaction()
+    def test_uri_mixin_queues_update_on_slug_fields(self):
+        class Base:
+            @classmethod
+            def on_modification(cls, mode, records, field_names=None):
+                pass
+
+        class Resource(VoyagerURIMixin, Base):
+            __name__ = 'test.resource'
+            _uri_fields = {'name'}
+            __queue__ = Mock()
+
+            @classmethod
+            def generate_uri(cls, records, sites=None):
+                pass
+
+        URI = SimpleNamespace(
+            _get_resources=lambda: ['test.resource'],
+            deactivate_resources=Mock())
+        models = {'www.uri': URI}
+        records = [Mock(id=1)]
+        with patch('trytond.modules.voyager.voyager.Pool',
+                return_value=SimpleNamespace(get=models.get)):
+            Resource.on_modification('write', records, field_names=['code'])
+            Resource.__queue__.update_uris.assert_not_called()
+
+            Resource.on_modification('write', records, field_names=['name'])
+            Resource.__queue__.update_uris.assert_called_once_with(records)
+
+            # The task enqueued by the transaction is not duplicated
+            other = Mock(id=2)
+            Resource.on_modification('write', records + [other],
+                field_names=['name'])
+            Resource.__queue__.update_uris.assert_called_with([other])
+            self.assertEqual(Resource.__queue__.update_uris.call_count, 2)
+
+            Resource.on_modification('delete', records)
+            URI.deactivate_resources.assert_called_once_with(records)
+
+    @with_transaction()
+    def test_uri_mixin_update_deactivates_inactive(self):
+        active, inactive = Mock(id=1, active=True), Mock(id=2, active=False)
+
+        class Resource(VoyagerURIMixin):
+            __name__ = 'test.resource'
+            search = Mock(return_value=[active, inactive])
+            generate_uri = Mock()
+
+        site = Mock()
+        URI = SimpleNamespace(deactivate_resources=Mock())
+        Site = SimpleNamespace(search=Mock(return_value=[site]))
+        models = {'www.uri': URI, 'www.site': Site}
+        with patch('trytond.modules.voyager.voyager.Pool',
+                return_value=SimpleNamespace(get=models.get)):
+            Resource.update_uris([active, inactive])
+
+        URI.deactivate_resources.assert_called_once_with([inactive])
+        Resource.generate_uri.assert_called_once_with([active], sites=[site])
+
 del ModuleTestCase
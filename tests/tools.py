@@ -1,5 +1,4 @@
 import os
-import threading
 import unittest
 import logging
 from datetime import datetime
@@ -11,11 +10,12 @@ from proteus import Model, Wizard
 from proteus import config as pconfig
 from trytond import wsgi
 from trytond.tests.test_tryton import drop_create, drop_db
-from werkzeug.serving import make_server
 import trytond.config as config
 from trytond.transaction import Transaction
 from trytond.backend import name
 
+from .server import ServerThread  # noqa: F401
+
 logger = logging.getLogger(__name__)
 
 # HINT: You need to install package 'playwright', and then execute the command 'playwright install'
@@ -28,31 +28,6 @@ logger = logging.getLogger(__name__)
 # HINT: You can temporarily define it with the command 'export TRYTOND_DATABASE__PATH=/tmp'
 
 
-class ServerThread(threading.Thread):
-    "Class that creates and manages a Tryton server in a new thread."
-    def __init__(self, app):
-        threading.Thread.__init__(self)
-
-        # When the system gets a '0' on the socket, it automatically finds a not-used port.
-        # SEE: https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
-        self.port = 0
-        self.host = 'localhost'
-
-        # Threaded is put to TRUE to ensure that the server is stopped.
-        # Werkzeug says: shutdown() must be called while serve_forever() is running in another thread, or it will deadlock.
-        self.server = make_server(self.host, self.port, app, threaded=True)
-
-        # Retrieve the port selected by the system
-        self.port = self.server.socket.getsockname()[1]
-
-    def run(self):
-        self.server.serve_forever()
-
-    def stop(self):
-        if self.is_alive():
-            logger.info('Stopping server...')
-            self.server.shutdown()
-
 def get_random_password(length=None):
     return token_hex(length)
 
@@ -1,9 +1,17 @@
+from collections import defaultdict, namedtuple
+
+from trytond.cache import Cache
 from trytond.model import (DeactivableMixin, ModelSQL, ModelView, fields,
     sequence_ordered)
+from trytond.pool import Pool
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 
+MenuItem = namedtuple('MenuItem', ['id', 'name', 'type', 'href', 'children'])
+
 
 class Menu(sequence_ordered(), DeactivableMixin, ModelSQL, ModelView):
     'WWW Menu'
@@ -36,19 +44,36 @@ class Menu(sequence_ordered(), DeactivableMixin, ModelSQL, ModelView):
     sequence = fields.Integer('Sequence')
     parent = fields.Many2One('www.menu', 'Parent')
     menus = fields.One2Many('www.menu', 'parent', 'Menus')
+    _tree_cache = Cache('www.menu.tree', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, menus, field_names=None):
+        super().on_modification(mode, menus, field_names=field_names)
+        cls._tree_cache.clear()
 
     @classmethod
     def validate(cls, menus):
-        for menu in menus:
-            menu.check_site()
+        super().validate(menus)
+        cls.check_site(menus)
 
-    def check_site(self):
-        if self.parent and self.site != self.parent.site:
-            raise UserError(gettext('voyager.msg_menu_site_mismatch'))
-        if self.menus:
-            for menu in self.menus:
-                if self.site != menu.site:
-                    raise UserError(gettext('voyager.msg_menu_site_mismatch'))
+    @classmethod
+    def check_site(cls, menus):
+        cursor = Transaction().connection.cursor()
+        menu = cls.__table__()
+        parent = cls.__table__()
+
+        # Check the menus against their parents and their children at once
+        for sub_menus in grouped_slice(menus):
+            sub_ids = [m.id for m in sub_menus]
+            cursor.execute(*menu
+                .join(parent, condition=menu.parent == parent.id)
+                .select(menu.id,
+                    where=(reduce_ids(menu.id, sub_ids)
+                        | reduce_ids(parent.id, sub_ids))
+                    & (menu.site != parent.site),
+                    limit=1))
+            if cursor.fetchone():
+                raise UserError(gettext('voyager.msg_menu_site_mismatch'))
 
     def get_rec_name(self, name):
         return self.name or ''
@@ -59,3 +84,55 @@ class Menu(sequence_ordered(), DeactivableMixin, ModelSQL, ModelView):
                 return self.url
             case 'internal':
                 return self.uri.get_href()
+
+    @classmethod
+    def get_tree(cls, site, language=None):
+        '''
+        Return the active menus of the site as a tuple of MenuItem (with their
+        children also as tuples of MenuItem).
+
+        The tree is loaded at once, with all the hrefs, and kept in cache until
+        a menu or URI is modified. It must be called while rendering a request
+        as the hrefs depend on the voyager context.
+        '''
+        pool = Pool()
+        VoyagerURI = pool.get('www.uri')
+        context = Transaction().context
+        voyager_context = context.get('voyager_context')
+        web_prefix = getattr(voyager_context, 'web_prefix', None)
+        if language is None:
+            language = context.get('language')
+
+        key = (site.id, language, web_prefix)
+        tree = cls._tree_cache.get(key)
+        if tree is not None:
+            return tree
+
+        with Transaction().set_context(language=language):
+            menus = cls.search([('site', '=', site.id)])
+            uris = [m.uri for m in menus if m.type == 'internal' and m.uri]
+            uri_hrefs = VoyagerURI.get_hrefs(uris)
+
+        children = defaultdict(list)
+        for menu in menus:
+            children[menu.parent.id if menu.parent else None].append(menu)
+
+        def href(menu):
+            match menu.type:
+                case 'external':
+                    return menu.url
+                case 'internal':
+                    return uri_hrefs.get(menu.uri.id) if menu.uri else None
+
+        def build(parent_id):
+            return tuple(MenuItem(
+                    id=menu.id,
+                    name=menu.name,
+                    type=menu.type,
+                    href=href(menu),
+                    children=build(menu.id),
+                    ) for menu in children[parent_id])
+
+        tree = build(None)
+        cls._tree_cache.set(key, tree)
+        return tree
@@ -1,34 +1,77 @@
+import base64
+import hashlib
+import hmac
+import json
 import logging
 import os
+import re
 import secrets
+import threading
+import time
 from collections.abc import Mapping
 from collections import defaultdict
 from datetime import datetime, timedelta
 from xml.sax.saxutils import escape, quoteattr
-import jinja2
-import markdown
-from dominate.tags import div, p
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from sql import Literal
 from trytond import backend
-from trytond.cache import Cache, freeze
+from trytond.cache import Cache, LRUDict, freeze
 import trytond.config as config
-from trytond.model import (DeactivableMixin, ModelSQL, ModelView, fields,
-    dualmethod)
+from trytond.model import (DeactivableMixin, Index, ModelSQL, ModelView,
+    Unique, fields, dualmethod)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval
 from trytond.wizard import Button, StateTransition, StateView, Wizard
 from trytond.transaction import Transaction
 from trytond.tools import grouped_slice, reduce_ids
-from werkzeug.routing import Map, Rule
-from werkzeug.wrappers import Response
-from werkzeug.exceptions import HTTPException
+
+from .events import SSE_RETRY, TriggerBroker, TriggerDataManager
+from .profiling import (METRICS_ENABLED, METRICS_TOKEN, NULL_PROFILE,
+    ComponentStats, EndpointStats, RequestProfile)
 
 CACHE_ENABLED = config.getboolean('voyager', 'cache_enabled', default=True)
 CACHE_TIMEOUT = config.getint('voyager', 'cache_timeout', default=60 * 60)
+URI_UPDATE_DELAY = config.getint('voyager', 'uri_update_delay', default=60)
+MARKDOWN_CACHE_SIZE = config.getint('voyager', 'markdown_cache_size',
+    default=1024)
+MAX_HEADER = 6
+SESSION_CLEAN_BATCH = config.getint('voyager', 'session_clean_batch',
+    default=1000)
+# Secret to sign the session cookies, they are the plain session_id without it
+SESSION_SECRET = config.get('voyager', 'session_secret', default=None)
+TEMPLATE_CACHE = config.getboolean('voyager', 'template_cache', default=True)
+# Placeholder of the components rendered at response time, with the signature
+# of its data
+ESI_RE = re.compile(r'<!--voyager-esi:([A-Za-z0-9_=-]+)\.([A-Za-z0-9_-]+)-->')
+ESI_MAX_DEPTH = 10
+# Secret to sign the placeholders, it must be shared by the processes that
+# share the cache. Without it each process signs with a random one
+ESI_SECRET = (config.get('voyager', 'esi_secret', default=None)
+    or SESSION_SECRET)
+_esi_secret_lock = threading.Lock()
 
 logger = logging.getLogger(__name__)
 
 
+def esi_secret():
+    '''
+    Return the secret to sign the placeholders
+
+    Without esi_secret nor session_secret in the configuration a random one
+    is generated, with a warning, the first time a placeholder is signed.
+    '''
+    global ESI_SECRET
+    if not ESI_SECRET:
+        with _esi_secret_lock:
+            if not ESI_SECRET:
+                logger.warning('Missing esi_secret in the voyager section of '
+                    'the configuration: the placeholders are signed with a '
+                    'random secret of the process, so the pages cached by '
+                    'the other processes lose their placeholders')
+                ESI_SECRET = secrets.token_hex(32)
+    return ESI_SECRET
+
+
 def normalize_cache_value(value):
     if isinstance(value, Mapping):
         return {
@@ -62,13 +105,30 @@ def render_component(name, lazy=False, **kwargs):
     Given a component __name___, return the render, if we set the lazy flag to
     true, we use the lazy render (render_lazy component method) instead of try
     render the component
+
+    The html is serialized here, so the htmx attributes are written with
+    dashes, and marked as safe for the templates
     """
+    from markupsafe import Markup
+    from .serializer import serialize
     pool = Pool()
     Component = pool.get(name)
     component = Component(render=False)
     if lazy:
-        return component.render_lazy()
-    return component.tag()
+        return Markup(serialize(component.render_lazy()))
+    return Markup(serialize(component.tag()))
+
+def menu_tree(language=None):
+    """
+    Return the tree of menus of the site being rendered as MenuItem tuples,
+    with the hrefs resolved at once (see Menu.get_tree)
+    """
+    pool = Pool()
+    Menu = pool.get('www.menu')
+    site = getattr(Transaction().context.get('voyager_context'), 'site', None)
+    if not site:
+        return ()
+    return Menu.get_tree(site, language)
 
 
 class VoyagerCache(Cache):
@@ -79,6 +139,8 @@ class VoyagerCache(Cache):
 
 class CacheManager:
     caches = {}
+    contexts = Cache('voyager.request_context', context=False,
+        duration=CACHE_TIMEOUT)
 
     @classmethod
     def get(cls, site_id):
@@ -91,10 +153,142 @@ class CacheManager:
                 duration=CACHE_TIMEOUT)
         return cls.caches[key]
 
+    @classmethod
+    def get_context(cls, site_id, user_id, language=None, cached=True):
+        '''
+        Return the items of the request context with the preferences of the
+        user and the language
+
+        They are normalized once and kept by site, user and language in a
+        trytond cache, so clear() reaches all the processes
+        '''
+        key = (site_id, user_id, language)
+        cached = cached and CACHE_ENABLED
+        if cached:
+            context = cls.contexts.get(key)
+            if context is not None:
+                return context
+
+        User = Pool().get('res.user')
+        context = User._get_preferences(User(user_id), context_only=True)
+        context = normalize_cache_value(dict(context))
+        context['language'] = language or 'en'
+        context = tuple(context.items())
+        if cached:
+            cls.contexts.set(key, context)
+        return context
+
     @classmethod
     def clear(cls):
         for cache in cls.caches.values():
             cache.clear()
+        cls.contexts.clear()
+
+    @classmethod
+    def evict(cls, database):
+        '''
+        Remove the in-memory entries of database, once its pool is stopped
+        '''
+        for key in [k for k in list(cls.caches) if k[0] == database]:
+            cls.caches.pop(key, None)
+        for key in [k for k in list(Site._site_info_cache) if k[0] == database]:
+            Site._site_info_cache.pop(key, None)
+        Site._site_info_versions.pop(database, None)
+        for key in [k for k in list(Component._templates) if k[0] == database]:
+            Component._templates.pop(key, None)
+
+
+class MarkdownRenderer:
+    '''
+    Render markdown to html reusing the converters (which are expensive to
+    build) and keeping the last rendered texts in memory
+    '''
+    extensions = ['tables', 'toc', 'attr_list']
+    header_re = re.compile(r'<(/?)h([1-6])(?=[\s/>])')
+    _converters = []
+    _cache = LRUDict(MARKDOWN_CACHE_SIZE)
+    _lock = threading.Lock()
+    _hits = 0
+    _misses = 0
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def render(cls, text, start_header=1, load=None):
+        '''
+        Return the html of text, load is an optional function that given the
+        digest of text returns the stored html (or None) to avoid converting
+        it
+        '''
+        digest = cls.digest(text)
+        key = (digest, start_header)
+        with cls._lock:
+            try:
+                html = cls._cache[key]
+            except KeyError:
+                cls._misses += 1
+            else:
+                cls._hits += 1
+                return html
+
+        html = load(digest) if load else None
+        if html is None:
+            try:
+                html = cls.convert(text)
+            except Exception:
+                logger.warning('Error rendering markdown', exc_info=True)
+                return ''
+        html = cls.shift_headers(html, start_header)
+        with cls._lock:
+            cls._cache[key] = html
+        return html
+
+    @classmethod
+    def convert(cls, text):
+        with cls._lock:
+            converter = cls._converters.pop() if cls._converters else None
+        if converter is None:
+            import markdown
+            converter = markdown.Markdown(output_format='xhtml',
+                extensions=cls.extensions)
+        try:
+            return converter.reset().convert(text)
+        finally:
+            with cls._lock:
+                cls._converters.append(converter)
+
+    @classmethod
+    def shift_headers(cls, html, start_header):
+        '''
+        Move the headers down so the first level is start_header, h6 is kept
+        as the lowest level
+        '''
+        if start_header <= 1:
+            return html
+        offset = start_header - 1
+
+        def replace(match):
+            level = min(int(match.group(2)) + offset, MAX_HEADER)
+            return f'<{match.group(1)}h{level}'
+        return cls.header_re.sub(replace, html)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'hits': cls._hits,
+                'misses': cls._misses,
+                'size': len(cls._cache),
+                'converters': len(cls._converters),
+                }
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._cache.clear()
+            cls._hits = cls._misses = 0
 
 
 class User(metaclass=PoolMeta):
@@ -114,7 +308,8 @@ class User(metaclass=PoolMeta):
 # default
 class VoyagerContext(dict):
     def __init__(self, site=None, session=None, cache=None, request=None,
-            adapter=None, endpoint_args=None, web_prefix=None):
+            adapter=None, endpoint_args=None, web_prefix=None, profile=None,
+            esi=False):
         super().__init__()
         self.site = site
         self.session = session
@@ -123,6 +318,15 @@ class VoyagerContext(dict):
         self.adapter = adapter
         self.endpoint_args = endpoint_args
         self.web_prefix = web_prefix
+        self.profile = profile
+        # The _esi components are rendered as placeholders that are replaced
+        # once the response is serialized
+        self.esi = esi
+        headers = getattr(request, 'headers', None) or {}
+        # htmx sends HX-Request on its requests and HX-Target with the id of
+        # the element to update
+        self.htmx = headers.get('HX-Request') == 'true'
+        self.hx_target = headers.get('HX-Target') if self.htmx else None
 
 
 class ErrorRequest:
@@ -160,6 +364,13 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
     route_method = fields.Selection([
         ('endpoint', 'Endpoint'),
         ('uri', 'URI')], 'Route Method')
+    # The routing tables (werkzeug maps and model classes) are kept in memory
+    # by process and dropped when the version stored in the trytond cache
+    # changes, which is cleared across processes
+    _site_info_cache = {}
+    _site_info_versions = {}
+    _site_info_version = Cache('www.site.site_info', context=False)
+    _site_hosts_cache = Cache('www.site.hosts', context=False)
 
     @staticmethod
     def default_session_lifetime():
@@ -173,6 +384,43 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
     def default_route_method():
         return 'endpoint'
 
+    @classmethod
+    def on_modification(cls, mode, sites, field_names=None):
+        pool = Pool()
+        Menu = pool.get('www.menu')
+        super().on_modification(mode, sites, field_names=field_names)
+        cls._site_info_version.clear()
+        cls._site_hosts_cache.clear()
+        # The hrefs of the menu trees depend on the url and route method
+        Menu._tree_cache.clear()
+
+    @classmethod
+    def match_site(cls, request):
+        '''
+        Return the id, type and web prefix of the site whose url matches the
+        host and the path of the request, or None
+
+        The longest path of the urls with the same host wins.
+        '''
+        sites = cls._site_hosts_cache.get('sites')
+        if sites is None:
+            sites = []
+            for site in cls.search([]):
+                url = urlparse(site.url)
+                sites.append((url.netloc.lower(), url.path.rstrip('/'),
+                        site.id, site.type))
+            sites.sort(key=lambda s: len(s[1]), reverse=True)
+            sites = tuple(sites)
+            cls._site_hosts_cache.set('sites', sites)
+
+        host = request.host.lower()
+        path = request.path
+        for netloc, prefix, site_id, site_type in sites:
+            if netloc != host:
+                continue
+            if not prefix or path == prefix or path.startswith(prefix + '/'):
+                return site_id, site_type, prefix or None
+
     def path_from_view(self, view):
         pool = Pool()
 
@@ -209,6 +457,7 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
         Given a request and site, check if the request uses any of the site
         endpoints and return the endpoint, args, adapter and endpoint_args
         '''
+        from werkzeug.exceptions import HTTPException
         pool = Pool()
         VoyagerURI = pool.get('www.uri')
 
@@ -278,9 +527,22 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
     @classmethod
     def dispatch(cls, site_type, site_id, request, user_id=None,
             web_prefix=None):
+        profile = RequestProfile.start(request)
+        try:
+            response = cls._dispatch(site_type, site_id, request,
+                user_id=user_id, web_prefix=web_prefix, profile=profile)
+        finally:
+            profile.stop()
+        profile.finish(response)
+        return response
+
+    @classmethod
+    def _dispatch(cls, site_type, site_id, request, user_id=None,
+            web_prefix=None, profile=NULL_PROFILE):
+        from werkzeug.wrappers import Response
+        from .serializer import serialize
         pool = Pool()
         Session = pool.get('www.session')
-        User = pool.get('res.user')
 
         if not user_id:
             user_id = config.getint('voyager', 'user_id')
@@ -304,6 +566,9 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
             endpoint = error['endpoint']
             args = error.get('args', {})
             request_to_render = ErrorRequest(request, args)
+        if profile is not NULL_PROFILE:
+            profile.endpoint = endpoint
+        profile.mark('routing')
 
         if not language:
             language = Transaction().context.get('language')
@@ -324,6 +589,8 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
             Component = pool.get(component_model)
         except:
             raise ValueError('No component found %s' % component_model)
+        if profile is not NULL_PROFILE:
+            profile.budget = getattr(Component, '_query_budget', None)
 
         if request_to_render.method == 'POST':
             # In case we have a post method, use the request form as args. This
@@ -341,33 +608,25 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
         # Check the session
         with Transaction().set_context(site=site):
             session = Session().get(request_to_render)
+        profile.mark('session')
 
         cache = site.get_cache(session, request_to_render)
         voyager_context = VoyagerContext(site=site, session=session,
             cache=cache, request=request_to_render, adapter=adapter,
-            endpoint_args=endpoint_args, web_prefix=web_prefix)
+            endpoint_args=endpoint_args, web_prefix=web_prefix,
+            profile=profile, esi=True)
         system_user_id = session.system_user and session.system_user.id
         user_id = system_user_id or user_id
-        if cache:
-            context = cache.get('user-preferences-%d' % user_id)
-        else:
-            context = None
-        if not context:
-            user = User(user_id)
-            context = User._get_preferences(user, context_only=True)
-            if cache:
-                cache.set('user-preferences-%d' % user_id, context)
-            if not language:
-                language = 'en'
-            context['language'] = language
-
-        # Convert from cache immutable structures to regular Python
-        # containers so Tryton caches can freeze the request context.
-        context = normalize_cache_value(dict(context))
+        context = dict(CacheManager.get_context(site.id, user_id, language,
+                cached=bool(cache)))
+        # Convert to regular Python containers so Tryton caches can freeze the
+        # request context.
         context.update(normalize_cache_value(
                 site._get_context(session, component_model, args)))
-        with Transaction().set_context(voyager_context=voyager_context,
-                path=request_to_render.path, **context), Transaction().set_user(user_id):
+        profile.mark('preferences')
+        context = dict(context, voyager_context=voyager_context,
+            path=request_to_render.path)
+        with Transaction().set_context(**context), Transaction().set_user(user_id):
             # Get the component object and function
             try:
                 Component = pool.get(component_model)
@@ -423,11 +682,35 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
             for field in Component._fields.keys():
                 if field not in args.keys():
                     instance_variables[field] = None
+            profile.mark('arguments')
+
+            # htmx requests targeting a fragment of the endpoint only render
+            # that fragment
+            fragment = None
+            if (not error and component_function == 'tag'
+                    and voyager_context.hx_target in getattr(
+                        Component, '_fragments', {})):
+                fragment = voyager_context.hx_target
 
             # TODO: make more efficent the way we get the component, right
             # now, even if we don't use the compoent we "execute" the render
             # function
-            if function_variables:
+            if fragment:
+                instance_variables['render'] = False
+                component = Component(**instance_variables)
+                response = component.fragment(fragment)
+            elif (not error and component_function == 'tag'
+                    and not function_variables
+                    and getattr(Component, '_stream', False)):
+                # The body is rendered while it is sent, so the transaction
+                # must be kept until the response is closed
+                instance_variables['render'] = False
+                component = Component(**instance_variables)
+                response = Response(
+                    cls._stream_response(component, context, user_id),
+                    content_type='text/html')
+                response.keep_transaction = True
+            elif function_variables:
                 instance_variables['render'] = False
                 component = Component(**instance_variables)
                 #TODO: we need to handle the error pages here
@@ -436,17 +719,15 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
                 component = Component(**instance_variables)
                 #TODO: we need to handle the error pages here
                 response = getattr(component, component_function)()
+            profile.mark('render')
 
-            # Render the content and prepare the response. The DOMinate render
-            # can handle the raw() objects and any tag (html_tag) we send any
-            # other format will raise a traceback
+            # Render the content and prepare the response. The serializer
+            # handles the DOMinate tags and raw() objects and writes the htmx
+            # attributes with dashes
             if response and not isinstance(response, Response):
-                if not response:
-                    response = ''
-                #TODO: Temporary solution until DOMinate render htmx tags:
-                # https://github.com/Knio/dominate/issues/193
-                response = response.render().replace('hx_', 'hx-')
+                response = Component.assemble(serialize(response))
                 response = Response(response, content_type='text/html')
+            profile.mark('serialize')
             if response and error and error.get('status'):
                 response.status_code = error['status']
 
@@ -455,9 +736,30 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
                 response.headers['HX-Trigger'] = ', '.join(
                     list(Trigger.get_triggers()))
             if response:
-                response.set_cookie('session_id', session.session_id)
+                response.set_cookie('session_id', session.token)
+                # The content depends on the htmx headers
+                response.vary.add('HX-Request')
+                if getattr(Component, '_fragments', None):
+                    response.vary.add('HX-Target')
             return response
 
+    @classmethod
+    def _stream_response(cls, component, context, user_id):
+        '''
+        Yield the html of the nodes of the component stream in the context of
+        the request
+        '''
+        from .serializer import serialize
+        transaction = Transaction()
+        with transaction.set_context(**context), transaction.set_user(user_id):
+            try:
+                for node in component.stream():
+                    yield Component.assemble(serialize(node))
+            except Exception:
+                # The response is already started, it can only be truncated
+                logger.exception('Error streaming %s', component.__name__)
+                transaction.rollback()
+
     def template_context(self):
         context = Transaction().context.copy()
         return context
@@ -473,7 +775,29 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
                 function inside the component "model_name". We need the
                 endpoint to have the SAME NAME as the function, otherwise, the
                 endpoint will fail.
+
+        The result is kept in memory by site and web_prefix, so the routing
+        tables are built once per process until a site is modified.
         '''
+        database = Transaction().database.name
+        version = self._site_info_version.get('version')
+        if version is None:
+            version = secrets.token_hex(8)
+            self._site_info_version.set('version', version)
+        if self._site_info_versions.get(database) != version:
+            for key in [k for k in list(self._site_info_cache)
+                    if k[0] == database]:
+                self._site_info_cache.pop(key, None)
+            self._site_info_versions[database] = version
+        key = (database, self.id, self.type, self.url, web_prefix)
+        info = self._site_info_cache.get(key)
+        if info is None:
+            info = self._site_info_cache[key] = self._get_site_info(
+                web_prefix)
+        return info
+
+    def _get_site_info(self, web_prefix):
+        from werkzeug.routing import Map, Rule
         pool = Pool()
 
         web_map = Map()
@@ -531,29 +855,150 @@ class Site(DeactivableMixin, ModelSQL, ModelView):
 
     def rendermarkdown(self, text, start_header=1):
         '''Return html text from markdown format'''
+        pool = Pool()
+        MarkdownCache = pool.get('www.markdown.cache')
+
         if not text:
             return ''
+        # Without models storing their markdown there is nothing to look up
+        load = MarkdownCache.get_html if MarkdownCache.is_used() else None
+        return MarkdownRenderer.render(text, start_header, load=load)
 
-        try:
-            text = markdown.markdown(text, output_format='xhtml',
-                extensions=['tables', 'toc', 'attr_list'])
-        except Exception as e:
-            print(f'Error: {e}')
-            return ''
 
-        if start_header > 1:
-            MAX_HEADER = 6
+class MarkdownCache(ModelSQL):
+    'Markdown Cache'
+    __name__ = 'www.markdown.cache'
 
-            # Because we cannot replace h6 with a lower one, we need to start replacing from h5 to h1
-            for level in range(MAX_HEADER - 1, 0, -1):
-                replc = level + (start_header - 1)
+    resource_model = fields.Char('Model', required=True)
+    record = fields.Integer('Record', required=True)
+    field = fields.Char('Field', required=True)
+    language = fields.Char('Language', required=True)
+    content_hash = fields.Char('Content Hash', required=True)
+    html = fields.Text('HTML')
+    _used = None
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.content_hash, Index.Equality())),
+                Index(t,
+                    (t.resource_model, Index.Equality()),
+                    (t.record, Index.Range()),
+                    (t.field, Index.Equality())),
+                })
+
+    @classmethod
+    def is_used(cls):
+        'Return True if any model of the pool stores its markdown'
+        if cls._used is None:
+            cls._used = any(
+                isinstance(Model, type)
+                and issubclass(Model, VoyagerMarkdownMixin)
+                and Model._markdown_fields
+                for _, Model in Pool().iterobject())
+        return cls._used
+
+    @classmethod
+    def get_html(cls, digest):
+        '''
+        Return the stored html for the markdown with the digest
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        cursor.execute(*table.select(table.html,
+                where=table.content_hash == digest,
+                limit=1))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def store(cls, records, field_names):
+        '''
+        Render and store the markdown of field_names for the records in all
+        the languages
+        '''
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        if not records:
+            return
+        Model = records[0].__class__
+        default_language = config.get('database', 'language')
+        translatable = Lang.get_translatable_languages()
+
+        cls.clean(records, field_names)
+        to_create = []
+        for field_name in field_names:
+            if getattr(Model._fields[field_name], 'translate', False):
+                languages = translatable
+            else:
+                languages = [default_language]
+            for language in languages:
+                with Transaction().set_context(language=language):
+                    for record in Model.browse([r.id for r in records]):
+                        text = getattr(record, field_name)
+                        if not text:
+                            continue
+                        try:
+                            html = MarkdownRenderer.convert(text)
+                        except Exception:
+                            logger.warning('Error rendering markdown of %s',
+                                record, exc_info=True)
+                            continue
+                        to_create.append({
+                                'resource_model': Model.__name__,
+                                'record': record.id,
+                                'field': field_name,
+                                'language': language,
+                                'content_hash': MarkdownRenderer.digest(text),
+                                'html': html,
+                                })
+        if to_create:
+            cls.create(to_create)
 
-                if replc > MAX_HEADER:
-                    replc = MAX_HEADER
+    @classmethod
+    def clean(cls, records, field_names=None):
+        if not records:
+            return
+        model_name = records[0].__name__
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        for sub_records in grouped_slice(records):
+            where = ((table.resource_model == model_name)
+                & reduce_ids(table.record, [r.id for r in sub_records]))
+            if field_names is not None:
+                where &= table.field.in_(list(field_names))
+            cursor.execute(*table.delete(where=where))
+
+
+class VoyagerMarkdownMixin:
+    '''
+    Store the html of the markdown fields listed in _markdown_fields when
+    they are modified, so Site.rendermarkdown does not need to convert them
+    when rendering the pages.
+    '''
+    __slots__ = ()
+    _markdown_fields = []
 
-                text = text.replace(f'<h{level}', f'<h{replc}').replace(f'</h{level}>', f'</h{replc}>')
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        MarkdownCache = pool.get('www.markdown.cache')
 
-        return text
+        super().on_modification(mode, records, field_names=field_names)
+        if not cls._markdown_fields:
+            return
+        if mode == 'delete':
+            MarkdownCache.clean(records)
+            return
+        to_store = set(cls._markdown_fields)
+        if field_names is not None:
+            to_store &= set(field_names)
+        if to_store:
+            MarkdownCache.store(records, sorted(to_store))
 
 
 class Session(ModelSQL, ModelView):
@@ -565,14 +1010,27 @@ class Session(ModelSQL, ModelView):
     user = fields.Many2One('web.user', 'User', ondelete='CASCADE')
     system_user = fields.Many2One('res.user', 'System User', ondelete='CASCADE')
     expiration_date = fields.DateTime('Expiration Date', required=True)
-    #TODO: create cron to clean sessions
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('session_id_unique', Unique(t, t.session_id),
+                'voyager.msg_session_id_unique'),
+            ]
+        cls._sql_indexes.add(Index(t, (t.expiration_date, Index.Range())))
 
     @classmethod
     def get(cls, request):
         create_session = False
+        session_id = None
         if 'session_id' in request.cookies:
+            session_id = cls.session_id_from_token(
+                request.cookies['session_id'])
+        if session_id:
             sessions = cls.search([
-                ('session_id', '=', request.cookies['session_id']),
+                ('session_id', '=', session_id),
             ], limit=1)
 
             if not sessions:
@@ -592,6 +1050,54 @@ class Session(ModelSQL, ModelView):
             session = cls.new()
         return session
 
+    @staticmethod
+    def _sign(payload):
+        digest = hmac.new(SESSION_SECRET.encode(), payload.encode(),
+            hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:16]).rstrip(b'=').decode()
+
+    @property
+    def token(self):
+        '''
+        Return the value of the session cookie
+
+        With a session_secret the token is "session_id.expiry.signature" so
+        the forged and expired cookies are rejected without a query
+        '''
+        if not SESSION_SECRET:
+            return self.session_id
+        expiry = int(self.expiration_date.timestamp())
+        digits = ''
+        while True:
+            expiry, digit = divmod(expiry, 36)
+            digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+            if not expiry:
+                break
+        payload = f'{self.session_id}.{digits}'
+        return f'{payload}.{self._sign(payload)}'
+
+    @classmethod
+    def session_id_from_token(cls, token):
+        '''
+        Return the session_id of the token or None if the token is not valid
+        '''
+        if not SESSION_SECRET:
+            return token
+        try:
+            session_id, expiry, signature = token.split('.')
+            payload = f'{session_id}.{expiry}'
+            expiry = int(expiry, 36)
+            # compare_digest only accepts ASCII strings, the cookie may not be
+            valid = hmac.compare_digest(signature.encode('utf-8'),
+                cls._sign(payload).encode('utf-8'))
+        except (ValueError, UnicodeError):
+            return None
+        if not valid:
+            return None
+        if expiry < datetime.now().timestamp():
+            return None
+        return session_id
+
     def update_expiration_date(self):
         last_update = self.write_date or self.create_date
         if (last_update + timedelta(
@@ -616,7 +1122,7 @@ class Session(ModelSQL, ModelView):
         Site = pool.get('www.site')
 
         site = Site(Transaction().context.get('site'))
-        session_id = secrets.token_urlsafe()
+        session_id = secrets.token_urlsafe(16)
 
         session = cls()
         session.site = site
@@ -626,12 +1132,65 @@ class Session(ModelSQL, ModelView):
         session.save()
         return session
 
+    @classmethod
+    def _clean_expired_where(cls, session):
+        '''
+        Return the SQL condition of the sessions that can be deleted
+        '''
+        return session.expiration_date < datetime.now()
+
+    @classmethod
+    def clean_expired(cls, batch_size=None):
+        '''
+        Delete the expired sessions in batches of batch_size, committing
+        after each batch so the table is not locked by a long delete
+
+        Return the number of deleted sessions
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        session = cls.__table__()
+
+        if batch_size is None:
+            batch_size = SESSION_CLEAN_BATCH
+        deleted = 0
+        while True:
+            cursor.execute(*session.select(session.id,
+                    where=cls._clean_expired_where(session),
+                    limit=batch_size))
+            ids = [i for i, in cursor]
+            if not ids:
+                break
+            cursor.execute(*session.delete(
+                    where=reduce_ids(session.id, ids)))
+            transaction.commit()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+        return deleted
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('www.session|clean_expired', "Clean Expired Web Sessions"))
+
 
 class Component(ModelView):
     'Component'
     __slots__ = ['_tag', 'cached']
     _path = None
     _cached = True
+    # Render as a placeholder replaced with the component from its own cache
+    # when the response is assembled, so its changes do not invalidate the
+    # cached components that include it
+    _esi = False
+    _template_sources = {}
+    _templates = {}
 
     def __init__(self, *args, **kwargs):
         render = True
@@ -672,6 +1231,18 @@ class Component(ModelView):
         if hasattr(Transaction().context.get('voyager_context'), 'session'):
             return Transaction().context.get('voyager_context').session
 
+    @property
+    def htmx(self):
+        'Return True if the request is sent by htmx'
+        return getattr(Transaction().context.get('voyager_context'), 'htmx',
+            False)
+
+    @property
+    def hx_target(self):
+        'Return the id of the element the htmx request updates'
+        return getattr(Transaction().context.get('voyager_context'),
+            'hx_target', None)
+
     @classmethod
     def web_prefix(cls):
         if hasattr(Transaction().context.get('voyager_context'), 'web_prefix'):
@@ -692,37 +1263,112 @@ class Component(ModelView):
         return self._path
 
     @classmethod
-    def load_template(cls, name):
+    def template_path(cls, name):
         if '/' in name:
             module, name = name.split('/', 1)
             path = os.path.join(os.path.dirname(__file__), '..', module)
             path = os.path.abspath(path)
         else:
             path = os.path.abspath(os.path.dirname(__file__))
-        path = os.path.join(path, 'www', name)
-        with open(path) as f:
-            return f.read()
+        return os.path.join(path, 'www', name)
+
+    @classmethod
+    def load_template(cls, name):
+        path = cls.template_path(name)
+        source = cls._template_sources.get(path) if TEMPLATE_CACHE else None
+        if source is None:
+            with open(path) as f:
+                source = f.read()
+            if TEMPLATE_CACHE:
+                cls._template_sources[path] = source
+        return source
+
+    @staticmethod
+    def template_names(module):
+        'Yield the names of the templates in the www folder of module'
+        root = os.path.abspath(os.path.join(
+                os.path.dirname(__file__), '..', module, 'www'))
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), root)
+                yield f'{module}/{name}'
+
+    @classmethod
+    def preload_templates(cls, modules):
+        '''
+        Load the sources of the templates in the www folder of the modules
+        '''
+        for module in modules:
+            for name in cls.template_names(module):
+                cls.load_template(name)
+
+    @classmethod
+    def compile_templates(cls, modules):
+        '''
+        Compile the templates of each module for the components it registers,
+        for the site of the voyager context
+        '''
+        pool = Pool()
+        for module in modules:
+            names = list(cls.template_names(module))
+            if not names:
+                continue
+            for entry in Pool.classes['model'].get(module, []):
+                # The entries are (class, depends) on the recent versions
+                klass = entry[0] if isinstance(entry, tuple) else entry
+                if not issubclass(klass, Component):
+                    continue
+                try:
+                    Model = pool.get(klass.__name__)
+                except KeyError:
+                    continue
+                for name in names:
+                    try:
+                        Model.get_template(name)
+                    except Exception:
+                        logger.warning('Error compiling %s for %s', name,
+                            Model.__name__, exc_info=True)
 
     @classmethod
     def template_context(cls):
-        return cls.context['site'].template_context()
+        site = Transaction().context['voyager_context'].site
+        return site.template_context()
 
     @classmethod
     def get_global_functions(cls):
+        from .middleware import static_url
         return {
             'component': component,
+            'menu_tree': menu_tree,
             'render_component': render_component,
+            'static_url': static_url,
             }
 
+    @classmethod
+    def get_template(cls, name):
+        '''
+        Return the compiled template, which is kept by database, component
+        and site
+        '''
+        site = getattr(Transaction().context.get('voyager_context'), 'site',
+            None)
+        key = (Transaction().database.name, cls.__name__, name,
+            site.id if site else None)
+        template = cls._templates.get(key) if TEMPLATE_CACHE else None
+        if template is None:
+            source = cls.load_template(name)
+            env = cls.get_environment()
+            template = env.from_string(source)
+            template.globals.update(cls.get_global_functions())
+            if TEMPLATE_CACHE:
+                cls._templates[key] = template
+        return template
+
     @classmethod
     def render_template(cls, template, **kwargs):
-        template = cls.load_template(template)
         context = cls.template_context().copy()
         context.update(kwargs)
-        env = cls.get_environment()
-        template = env.from_string(template)
-        template.globals.update(cls.get_global_functions())
-        return template.render(context)
+        return cls.get_template(template).render(context)
 
     @classmethod
     def get_template_paths(cls):
@@ -736,9 +1382,11 @@ class Component(ModelView):
         Downstream modules can override this method to easily make changes
         to environment
         """
+        import jinja2
         loader = jinja2.FileSystemLoader(cls.get_template_paths())
         env = jinja2.Environment(loader=loader)
-        env.filters.update(cls.context['site'].template_filters())
+        site = Transaction().context['voyager_context'].site
+        env.filters.update(site.template_filters())
         return env
 
     def render(self):
@@ -762,14 +1410,98 @@ class Component(ModelView):
         if hasattr(self.context.get('voyager_context'), 'cache'):
             return self.context.get('voyager_context').cache
 
-    def create_tag(self):
+    def esi_placeholder(self):
+        '''
+        Return the placeholder with the name and the field values to build
+        the component when the response is assembled
+        '''
+        from dominate.util import raw
+        from trytond.model import Model
+        from trytond.protocols.jsonrpc import JSONEncoder
+
+        values = {}
+        for name in self._fields:
+            value = getattr(self, name, None)
+            if isinstance(value, Model):
+                value = value.id
+            elif isinstance(value, (list, tuple)):
+                value = [v.id if isinstance(v, Model) else v for v in value]
+            values[name] = value
+        data = json.dumps([self.__name__, values], cls=JSONEncoder,
+            separators=(',', ':'))
+        data = base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+        return raw(f'<!--voyager-esi:{data}.{self.esi_signature(data)}-->')
+
+    @staticmethod
+    def esi_signature(data):
+        digest = hmac.new(esi_secret().encode(), data.encode(),
+            hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:16]).rstrip(b'=').decode()
+
+    @classmethod
+    def assemble(cls, html, depth=0):
+        '''
+        Replace the placeholders of html with the html of their components
+
+        Only the placeholders signed by esi_placeholder are rendered, the
+        others (e.g. written in a markdown text) are removed.
+        '''
+        from trytond.protocols.jsonrpc import JSONDecoder
+        from .serializer import serialize
+
+        if depth >= ESI_MAX_DEPTH:
+            logger.warning('Too many nested placeholders, they are removed')
+            return ESI_RE.sub('', html)
+
+        pool = Pool()
+
+        def replace(match):
+            data, signature = match.groups()
+            if not hmac.compare_digest(signature.encode(),
+                    cls.esi_signature(data).encode()):
+                logger.warning('Invalid placeholder signature, it is removed')
+                return ''
+            data = base64.urlsafe_b64decode(data).decode('utf-8')
+            name, values = json.loads(data, object_hook=JSONDecoder())
+            try:
+                Model = pool.get(name)
+            except KeyError:
+                Model = None
+            if not (isinstance(Model, type) and issubclass(Model, Component)):
+                logger.warning('Placeholder of unknown component %s', name)
+                return ''
+            component = Model(render=False, **values)
+            component.create_tag(esi=False)
+            return cls.assemble(serialize(component._tag), depth + 1)
+        return ESI_RE.sub(replace, html)
+
+    def create_tag(self, esi=True):
+        if (esi and self._esi
+                and getattr(self.context.get('voyager_context'), 'esi',
+                    False)):
+            self._tag = self.esi_placeholder()
+            return
         use_cache = CACHE_ENABLED and self.cached and self.cache
+        key = None
         if use_cache:
             key = self.get_cache_key()
-            if key and self.cache and self.cache.get(key):
-                self._tag = self.cache.get(key)
+            tag = self.cache.get(key) if key else None
+            if tag:
+                self._tag = tag
+                if METRICS_ENABLED:
+                    ComponentStats.hit(self.__name__)
                 return
+        start = time.perf_counter()
         self._tag = self.render()
+        if METRICS_ENABLED:
+            size = None
+            if (use_cache and key
+                    and ComponentStats.sample_size(self.__name__)):
+                from .serializer import serialize
+                size = len(serialize(self._tag))
+            ComponentStats.rendered(self.__name__,
+                time.perf_counter() - start, cached=bool(use_cache and key),
+                size=size)
         if use_cache and key:
             try:
                 self.cache.set(key, self._tag)
@@ -807,6 +1539,19 @@ class Trigger():
     def get_triggers():
         return Transaction().context.get('triggers', set([]))
 
+    @staticmethod
+    def publish(trigger, sessions=None, data=''):
+        '''
+        Send the trigger to the event streams of the sessions (all the
+        sessions if None) once the transaction is committed
+        '''
+        name = trigger.name if isinstance(trigger, Trigger) else trigger
+        session_ids = None
+        if sessions is not None:
+            session_ids = [getattr(s, 'session_id', s) for s in sessions]
+        datamanager = Transaction().join(TriggerDataManager())
+        datamanager.events.append((name, session_ids, data))
+
 
 class Endpoint(Component):
     'Endpoint'
@@ -815,6 +1560,13 @@ class Endpoint(Component):
     _method = 'GET'
     _status = None
     _type = None
+    # Maximum number of SQL queries expected to render the endpoint
+    _query_budget = None
+    # The methods that render the element with the id of the key, they are
+    # used instead of the full page for the htmx requests targeting it
+    _fragments = {}
+    # Send the nodes yielded by stream() as they are rendered
+    _stream = False
 
     def __init__(self, *args, **kwargs):
         self.cached = self._cached
@@ -829,16 +1581,54 @@ class Endpoint(Component):
                 if isinstance(getattr(self, x), Trigger):
                     getattr(self, x).name = f"{self.__name__.replace('.','-')}_{x}"
 
+    def stream(self):
+        '''
+        Yield the nodes of the page in order, the first ones (like the head)
+        are sent while the next ones are rendered
+
+        Used instead of tag() when _stream is set
+        '''
+        yield self.tag()
+
+    def fragment(self, target):
+        '''
+        Return the tag of the fragment that renders the target element
+
+        It is cached apart from the full page of the endpoint
+        '''
+        use_cache = CACHE_ENABLED and self.cached and self.cache
+        key = None
+        if use_cache:
+            key = self.get_cache_key() + ('fragment', target)
+            tag = self.cache.get(key)
+            if tag:
+                if METRICS_ENABLED:
+                    ComponentStats.hit(f'{self.__name__}#{target}')
+                return tag
+        start = time.perf_counter()
+        tag = getattr(self, self._fragments[target])()
+        if METRICS_ENABLED:
+            ComponentStats.rendered(f'{self.__name__}#{target}',
+                time.perf_counter() - start, cached=bool(use_cache))
+        if use_cache:
+            try:
+                self.cache.set(key, tag)
+            except RecursionError:
+                logger.warning('RecursionError setting cache key: %s', key)
+        return tag
+
     def lazy_content(self):
         '''
         The alternative content to show while the component is loading
         '''
+        from dominate.tags import p
         return p('Loading...')
 
     def render_lazy(self):
         '''
         The loading div that we show when the component is loading.
         '''
+        from dominate.tags import div
         loading_div = div(hx_get=self.url(), hx_trigger='load')
         with loading_div:
             self.lazy_content()
@@ -870,7 +1660,11 @@ class Endpoint(Component):
 
                     Model = pool.get(field.model_name)
                     if hasattr(Model, 'to_request'):
-                        if Model.search([('id', '=', raw)]):
+                        # The instances are given by callers that know they
+                        # exist, like VoyagerURI.get_hrefs
+                        if isinstance(raw, Model):
+                            value = raw.to_request(cls.site, cls.__name__)
+                        elif Model.search([('id', '=', raw)]):
                             model = Model(raw)
                             value = model.to_request(cls.site, cls.__name__)
                 else:
@@ -924,6 +1718,99 @@ class Endpoint(Component):
         return f'{builder}'
 
 
+class Metrics(Endpoint):
+    '''
+    Return the request, component and markdown statistics collected in the
+    process as JSON. It only answers when voyager.metrics is enabled, to the
+    sessions of a system user or to the requests with the voyager
+    metrics_token as bearer token.
+
+    Sites that want to expose it must inherit it, setting __name__ and _type
+    '''
+    _url = '/voyager/metrics'
+    _cached = False
+    _query_budget = 10
+
+    def render(self):
+        from werkzeug.exceptions import Forbidden, NotFound
+        from werkzeug.wrappers import Response
+        if not METRICS_ENABLED:
+            return NotFound().get_response()
+        if not self.authorized():
+            return Forbidden().get_response()
+        return Response(json.dumps({
+                    'endpoints': EndpointStats.summary(),
+                    'components': ComponentStats.summary(),
+                    'markdown': MarkdownRenderer.stats(),
+                    }, default=str), content_type='application/json')
+
+    def authorized(self):
+        'Return True if the request can read the metrics'
+        if self.session and self.session.system_user:
+            return True
+        if not METRICS_TOKEN:
+            return False
+        request = self.context['voyager_context'].request
+        authorization = request.headers.get('Authorization', '')
+        try:
+            return hmac.compare_digest(authorization.encode('utf-8'),
+                f'Bearer {METRICS_TOKEN}'.encode('utf-8'))
+        except UnicodeError:
+            return False
+
+
+class EventStream(Endpoint):
+    '''
+    Stream the triggers published to the session as server-sent events, to
+    be used with the htmx sse extension:
+
+        div(hx_ext='sse', sse_connect=EventStream.url())
+        div(hx_get=..., hx_trigger=f'sse:{trigger.name}')
+
+    Sites that want to expose it must inherit it, setting __name__ and _type
+
+    Under VoyagerASGI the events are sent by the event loop, without holding a
+    thread. Under a WSGI server each stream holds a worker thread, so only
+    voyager sse_max_streams are served at once and the next ones get a 503
+    (the htmx extension reconnects after a while).
+    '''
+    _url = '/voyager/events'
+    _cached = False
+    _query_budget = 10
+
+    def render(self):
+        from werkzeug.wrappers import Response
+        headers = {
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            }
+        session_id = self.session.session_id
+        environ = getattr(self.context['voyager_context'].request, 'environ',
+            {})
+        if environ.get('voyager.asgi'):
+            environ['voyager.event_stream'] = session_id
+            # Without body nor Content-Length, the events follow
+            return Response(iter(()), content_type='text/event-stream',
+                headers=headers, direct_passthrough=True)
+
+        if not TriggerBroker.acquire_stream():
+            return Response('Too many event streams', status=503,
+                headers={'Retry-After': str(SSE_RETRY // 1000 or 1)})
+        subscription = TriggerBroker.subscribe(session_id)
+        response = Response(
+            TriggerBroker.stream(session_id, subscription),
+            content_type='text/event-stream',
+            headers=headers)
+
+        def close():
+            # The stream unsubscribes when it is closed, but only if it
+            # started
+            TriggerBroker.unsubscribe(session_id, subscription)
+            TriggerBroker.release_stream()
+        response.call_on_close(close)
+        return response
+
+
 class VoyagerURL():
 
     def to_request(self, site, component):
@@ -934,6 +1821,110 @@ class VoyagerURL():
         raise NotImplementedError('Method to_request not implemented')
 
 
+class URIUpdateDataManager:
+    '''
+    Keep by model the ids of the records with an update_uris task enqueued by
+    a transaction
+    '''
+
+    def __init__(self):
+        self.ids = defaultdict(set)
+
+    def __eq__(self, other):
+        return isinstance(other, URIUpdateDataManager)
+
+    def abort(self, trans):
+        self.ids.clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self.ids.clear()
+
+    def tpc_abort(self, trans):
+        self.ids.clear()
+
+
+class VoyagerURIMixin:
+    '''
+    Keep the URIs of a resource up to date when the resource is modified.
+
+    Models returned by VoyagerURI._get_resources that implement generate_uri
+    can inherit from this mixin, their URIs are regenerated by a queue task
+    (after commit, delayed and in batches) when any of the _uri_fields
+    changes, and deactivated when the record is deleted.
+    '''
+    __slots__ = ()
+    # Fields used to build the slugs of the URIs, None means any field
+    _uri_fields = None
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        VoyagerURI = pool.get('www.uri')
+
+        super().on_modification(mode, records, field_names=field_names)
+        if (not hasattr(cls, 'generate_uri')
+                or cls.__name__ not in VoyagerURI._get_resources()):
+            return
+        if mode == 'delete':
+            VoyagerURI.deactivate_resources(records)
+        elif mode == 'create' or cls._uri_fields_changed(field_names):
+            # A record modified again by the transaction is not enqueued
+            pending = cls._pending_uri_updates()
+            records = [r for r in records if r.id not in pending]
+            if not records:
+                return
+            pending.update(r.id for r in records)
+            with Transaction().set_context(
+                    queue_name='voyager',
+                    queue_batch=True,
+                    queue_scheduled_at=timedelta(seconds=URI_UPDATE_DELAY)):
+                cls.__queue__.update_uris(records)
+
+    @classmethod
+    def _uri_fields_changed(cls, field_names):
+        if cls._uri_fields is None or field_names is None:
+            return True
+        return bool(set(cls._uri_fields) & set(field_names))
+
+    @classmethod
+    def _pending_uri_updates(cls):
+        '''
+        Return the ids of the records with an update_uris task enqueued by
+        the transaction
+        '''
+        datamanager = Transaction().join(URIUpdateDataManager())
+        return datamanager.ids[cls.__name__]
+
+    @classmethod
+    def update_uris(cls, records):
+        pool = Pool()
+        Site = pool.get('www.site')
+        VoyagerURI = pool.get('www.uri')
+
+        # The task runs after commit, some records may have been deleted or
+        # deactivated meanwhile: the URIs of the inactive ones are deactivated
+        with Transaction().set_context(active_test=False):
+            records = cls.search([('id', 'in', [r.id for r in records])])
+        inactive = [r for r in records if not getattr(r, 'active', True)]
+        if inactive:
+            VoyagerURI.deactivate_resources(inactive)
+            records = [r for r in records if r not in inactive]
+        sites = Site.search([])
+        if not records or not sites:
+            return
+        for sub_records in grouped_slice(records):
+            cls.generate_uri(list(sub_records), sites=sites)
+
+
 class VoyagerURI(DeactivableMixin, ModelSQL, ModelView):
     'Voyager URI'
     __name__ = 'www.uri'
@@ -971,30 +1962,46 @@ class VoyagerURI(DeactivableMixin, ModelSQL, ModelView):
     def get_rec_name(self, name):
         return self.uri or ''
 
-    def _get_canonical_uri(self):
-        URI = self.__class__
-
-        language = Transaction().context.get('language')
-        related = URI.search([
-            ['OR',
-                ('main_uri', '=', self.id),
-                ('id', '=', self.id),
-            ],
-            ('language.code', '=', language)])
-        return related[0] if related else None
-
     @classmethod
     def get_canonical_uri(cls, uris, name):
-        result = {}
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        cursor = Transaction().connection.cursor()
+        uri = cls.__table__()
+        language = Lang.__table__()
 
-        for uri in uris:
-            if uri.main_uri:
-                canonical_found = uri.main_uri._get_canonical_uri()
-            elif uri.related_uris:
-                canonical_found = uri._get_canonical_uri()
-            else:
-                canonical_found = None
-            result[uri.id] = canonical_found or uri
+        result = {u.id: u.id for u in uris}
+        code = Transaction().context.get('language')
+        if not code:
+            return result
+
+        # The canonical URI is the URI of the context language in the group
+        # formed by the main URI and its related URIs
+        groups = defaultdict(list)
+        for record in uris:
+            root = record.main_uri.id if record.main_uri else record.id
+            groups[root].append(record.id)
+
+        canonicals = {}
+        for sub_roots in grouped_slice(list(groups)):
+            sub_roots = list(sub_roots)
+            query = (uri
+                .join(language, condition=uri.language == language.id)
+                .select(
+                    uri.id, uri.main_uri,
+                    where=(reduce_ids(uri.id, sub_roots)
+                        | reduce_ids(uri.main_uri, sub_roots))
+                    & (uri.active == Literal(True))
+                    & (language.code == code),
+                    order_by=[uri.id.asc]))
+            cursor.execute(*query)
+            for uri_id, main_uri in cursor:
+                canonicals.setdefault(main_uri or uri_id, uri_id)
+
+        for root, ids in groups.items():
+            if root in canonicals:
+                for id_ in ids:
+                    result[id_] = canonicals[root]
         return result
 
     @classmethod
@@ -1175,20 +2182,85 @@ class VoyagerURI(DeactivableMixin, ModelSQL, ModelView):
         cls.write(list(to_deactivate.values()), {'active': False})
         cls.save(to_save)
 
-    def get_href(self):
+    @classmethod
+    def deactivate_resources(cls, resources):
+        uris = []
+        for sub_resources in grouped_slice(resources):
+            uris.extend(cls.search([
+                        ('resource', 'in', [str(r) for r in sub_resources]),
+                        ]))
+        if uris:
+            cls.write(uris, {'active': False})
+
+    @classmethod
+    def on_modification(cls, mode, uris, field_names=None):
         pool = Pool()
+        Menu = pool.get('www.menu')
+        super().on_modification(mode, uris, field_names=field_names)
+        Menu._tree_cache.clear()
+
+    @classmethod
+    def get_hrefs(cls, uris):
+        '''
+        Return a dictionary with the href of each URI
+
+        When the site routes by URI the href is the canonical URI, otherwise
+        the url of its endpoint. The canonical URIs and their resources are
+        read at once for all the URIs.
+        '''
+        pool = Pool()
+        context = Transaction().context.get('voyager_context')
+        site = getattr(context, 'site', None)
+        web_prefix = getattr(context, 'web_prefix', None) or ''
+
+        canonical_ids = cls.get_canonical_uri(uris, 'canonical_uri')
+        canonicals = cls.browse(sorted(set(canonical_ids.values())))
+        canonicals = {u.id: u for u in canonicals}
+
+        # The endpoints check that the resources exist, do it for all of them
+        resource_ids = defaultdict(set)
+        for canonical_uri in canonicals.values():
+            if canonical_uri.resource:
+                resource = canonical_uri.resource
+                resource_ids[resource.__name__].add(resource.id)
+        resources = {}
+        for model_name, ids in resource_ids.items():
+            Model = pool.get(model_name)
+            for sub_ids in grouped_slice(ids):
+                for record in Model.search([('id', 'in', list(sub_ids))]):
+                    resources[str(record)] = record
+
+        hrefs = {}
+        for uri in uris:
+            canonical_uri = canonicals[canonical_ids[uri.id]]
+            if (site and site.route_method == 'uri'
+                    and canonical_uri.site.id == site.id):
+                hrefs[uri.id] = f'{web_prefix}{canonical_uri.uri}'
+                continue
+            resource = canonical_uri.resource
+            if resource:
+                # The missing resources are given by id as url does not
+                # search the instances
+                resource = resources.get(str(resource), resource.id)
+            hrefs[uri.id] = canonical_uri._get_endpoint_href(resource)
+        return hrefs
+
+    def get_href(self):
         canonical_uri = self.canonical_uri
-        resource = canonical_uri.resource
+        return canonical_uri._get_endpoint_href(canonical_uri.resource)
+
+    def _get_endpoint_href(self, resource):
+        'Return the url of the endpoint of the URI for resource'
+        pool = Pool()
         try:
-            Component = pool.get(canonical_uri.endpoint.name)
+            Component = pool.get(self.endpoint.name)
         except KeyError:
-            raise ValueError('No component found %s' %
-                canonical_uri.endpoint.name)
+            raise ValueError('No component found %s' % self.endpoint.name)
 
         if not resource:
             return Component.url()
 
-        resource_name = resource.__name__
+        resource_name = self.resource.__name__
         key = None
         for fieldname, field in Component._fields.items():
             if (isinstance(field, fields.Many2One)